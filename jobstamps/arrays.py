@@ -0,0 +1,190 @@
+# /jobstamps/arrays.py
+#
+# Storage of large NumPy arrays in stamps, such that they can be mapped
+# into memory instead of being read and copied when the stamp is loaded.
+#
+# When a result containing large arrays is stamped, wherever they appear
+# in it, their contents are pickled out of band using pickle protocol 5,
+# so that only the rest of the result passes through Python code while
+# pickling. The stamp starts with a header giving the position of a table
+# of the arrays' positions, followed by the contents of each array,
+# aligned so that they can be used in place, and then the table and the
+# pickled result. Keeping the arrays in the stamp means that they are
+# replaced atomically along with the rest of the result, and are copied
+# along with it between tiers.
+#
+# When a stamp is loaded, it is mapped into memory once as a numpy.memmap
+# and each array is a read-only numpy.memmap view of it. On POSIX systems,
+# replacing the stamp does not affect arrays already loaded from it. On
+# Windows, a file cannot be replaced while it is mapped, so re-running a
+# job fails while arrays loaded from its previous stamp are still in use.
+#
+# NumPy is only imported by this module to load a stamp which contains
+# arrays. Results are only checked for arrays if NumPy has already been
+# imported, since otherwise they cannot contain any.
+#
+# See /LICENCE.md for Copyright information
+"""Storage of large NumPy arrays in stamps, mapped into memory on load."""
+
+import io
+
+import os
+
+import pickle
+
+import struct
+
+import sys
+
+from jobstamps import fileutil
+
+try:
+    import copyreg
+except ImportError:  # pragma: no cover
+    import copy_reg as copyreg  # suppress(import-error)
+
+MAGIC = b"JSTMPNP1"
+
+_HEADER = struct.Struct(">8sQ")
+_COUNT = struct.Struct(">Q")
+_EXTENT = struct.Struct(">QQ")
+
+# Arrays are pickled out of band from this protocol onwards.
+_OUT_OF_BAND_PROTOCOL = 5
+
+# Offset of each array from the start of the stamp is a multiple of this.
+_ALIGNMENT = 64
+
+# Smaller arrays are pickled along with the rest of the result, since
+# mapping them costs more than copying them.
+_MAPPED_ARRAY_MINIMUM_BYTES = 1 << 16
+
+
+def _aligned(offset):
+    """Return offset rounded up to a multiple of _ALIGNMENT."""
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _rebuild_array(buffer, dtype, shape, order):
+    """Return array of dtype and shape over the out of band buffer.
+
+    If the stamp was mapped, buffer is a slice of its numpy.memmap, or a
+    read-only memoryview of one, and a numpy.memmap is returned.
+    """
+    import numpy  # suppress(import-error)
+
+    if isinstance(getattr(buffer, "obj", None), numpy.ndarray):
+        buffer = buffer.obj
+
+    if isinstance(buffer, numpy.ndarray):
+        array = buffer.view(dtype)
+    else:
+        array = numpy.frombuffer(buffer, dtype=dtype)
+
+    return array.reshape(shape, order=order)
+
+
+def dumps(value, protocol=pickle.HIGHEST_PROTOCOL, copy=False):
+    """Return (pickled value, list of array contents to store before it).
+
+    The list of array contents is empty if value does not contain any
+    arrays large enough to be mapped, in which case the pickled value can
+    be stored on its own. Otherwise, the contents in the list may share
+    memory with the arrays in value, unless copy is set.
+    """
+    numpy = sys.modules.get("numpy", None)
+    if numpy is None or protocol < _OUT_OF_BAND_PROTOCOL:
+        return pickle.dumps(value, protocol), list()
+
+    mapped = list()
+
+    def _out_of_band(buffer):
+        """Keep contents of buffer out of band if large, returning False."""
+        contents = buffer.raw()
+        if contents.nbytes < _MAPPED_ARRAY_MINIMUM_BYTES:
+            return True
+
+        mapped.append(contents.tobytes() if copy else contents)
+        return False
+
+    def _reduce_array(array):
+        """Reduce large array such that it is rebuilt by _rebuild_array."""
+        if (array.dtype.hasobject or
+                array.nbytes < _MAPPED_ARRAY_MINIMUM_BYTES or
+                not (array.flags.c_contiguous or array.flags.f_contiguous)):
+            return array.view(numpy.ndarray).__reduce_ex__(protocol)
+
+        order = "C" if array.flags.c_contiguous else "F"
+        return (_rebuild_array,
+                (pickle.PickleBuffer(array), array.dtype, array.shape, order))
+
+    # Large arrays, including memory maps, are rebuilt by _rebuild_array,
+    # so that arrays loaded from a mapped stamp are memory maps too. Other
+    # types are looked up in the dispatch table by the pickler itself, so
+    # this does not slow down pickling the rest of the result.
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[numpy.ndarray] = _reduce_array
+    dispatch_table[numpy.memmap] = _reduce_array
+
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol, buffer_callback=_out_of_band)
+    pickler.dispatch_table = dispatch_table
+    pickler.dump(value)
+    return buffer.getvalue(), mapped
+
+
+def write(path, pickled, mapped):
+    """Write the header, array contents in mapped and then pickled to path."""
+    fileobj, temporary = fileutil.temporary_file_beside(path)
+    try:
+        with fileobj:
+            extents = list()
+            end = _HEADER.size
+            for contents in mapped:
+                offset = _aligned(end)
+                end = offset + memoryview(contents).nbytes
+                extents.append((offset, end - offset))
+
+            fileobj.write(_HEADER.pack(MAGIC, end))
+            for contents, (offset, _) in zip(mapped, extents):
+                fileobj.write(b"\0" * (offset - fileobj.tell()))
+                fileobj.write(contents)
+
+            fileobj.write(_COUNT.pack(len(extents)))
+            for extent in extents:
+                fileobj.write(_EXTENT.pack(*extent))
+
+            fileobj.write(pickled)
+        fileutil.replace_file(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+def load(fileobj, contents=None):
+    """Return value stored in the stamp which fileobj reads from.
+
+    Arrays are returned as read-only numpy.memmap views of the file
+    fileobj reads from or, if the stamp was read into memory as contents,
+    as read-only views of contents.
+    """
+    fileobj.seek(0)
+    _, table_offset = _HEADER.unpack(fileobj.read(_HEADER.size))
+    fileobj.seek(table_offset)
+    count = _COUNT.unpack(fileobj.read(_COUNT.size))[0]
+    extents = [_EXTENT.unpack(fileobj.read(_EXTENT.size))
+               for _ in range(count)]
+
+    if contents is not None:
+        view = memoryview(contents)
+    elif extents:
+        import numpy  # suppress(import-error)
+        position = fileobj.tell()
+        view = numpy.memmap(fileobj, dtype="uint8", mode="r")
+        fileobj.seek(position)
+    else:
+        view = None
+
+    return pickle.load(fileobj,
+                       buffers=[view[offset:offset + length]
+                                for offset, length in extents])
@@ -0,0 +1,193 @@
+# /jobstamps/blobs.py
+#
+# Content addressed storage of stamped results, shared between stamps.
+#
+# A deduplicated result is pickled and stored once, in a file named after
+# the digest of its contents in a hidden subdirectory of the cache
+# directory. Each stamp holding that result is a small record naming the
+# digest. Since the contents of a blob never change, blobs which have
+# been read are kept in memory and shared by every stamp naming them.
+#
+# Blobs are not removed when the stamps naming them are. Instead, collect
+# removes the blobs which are not named by any stamp. Blobs which were
+# written or reused recently are kept, so that a blob being reused by a
+# job which has not yet written its stamp is not removed.
+#
+# See /LICENCE.md for Copyright information
+"""Content addressed storage of stamped results, shared between stamps."""
+
+import errno
+
+import hashlib
+
+import os
+
+import pickle
+
+import threading
+
+import time
+
+from collections import OrderedDict
+
+from jobstamps import fileutil
+from jobstamps import layout
+
+MAGIC = b"JSTMPBL1"
+
+DIRECTORY = ".jobstamps-blobs"
+
+_DIGEST_LENGTH = 40
+
+# Blobs are kept in memory once read, up to this many bytes in total.
+_MEMORY_BYTES = 1 << 26
+
+_MEMORY = OrderedDict()
+_MEMORY_LOCK = threading.Lock()
+_MEMORY_USED = [0]
+
+
+class MissingBlobError(IOError):
+    """The blob named by a stamp has been removed."""
+
+    pass
+
+
+def _blob_path(directory, digest):
+    """Return path to the blob with digest in directory."""
+    return os.path.join(directory, DIRECTORY, digest[:2], digest)
+
+
+def store(directory, pickled):
+    """Store pickled in directory, returning the record for a stamp.
+
+    If a blob with the same contents is already stored, it is marked as
+    recently used instead of being written again.
+    """
+    digest = hashlib.sha1(pickled).hexdigest()
+    path = _blob_path(directory, digest)
+
+    try:
+        os.utime(path, None)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+        fileutil.safe_mkdir(os.path.dirname(path))
+        fileutil.write_atomically(path, pickled)
+
+    return MAGIC + digest.encode("ascii")
+
+
+def _remember(digest, contents):
+    """Keep contents of blob with digest in memory, evicting others."""
+    with _MEMORY_LOCK:
+        if digest in _MEMORY or len(contents) > _MEMORY_BYTES:
+            return
+
+        _MEMORY[digest] = contents
+        _MEMORY_USED[0] += len(contents)
+        while _MEMORY_USED[0] > _MEMORY_BYTES:
+            _, evicted = _MEMORY.popitem(last=False)
+            _MEMORY_USED[0] -= len(evicted)
+
+
+def clear():
+    """Discard blobs kept in memory."""
+    with _MEMORY_LOCK:
+        _MEMORY.clear()
+        _MEMORY_USED[0] = 0
+
+
+def load(stamp, record):
+    """Return the value in the blob named by record, read from stamp.
+
+    record is the rest of the stamp after MAGIC. Raise MissingBlobError
+    if the blob has been removed.
+    """
+    digest = record[:_DIGEST_LENGTH].decode("ascii")
+
+    with _MEMORY_LOCK:
+        contents = _MEMORY.get(digest, None)
+        if contents is not None:
+            _MEMORY[digest] = _MEMORY.pop(digest)
+
+    if contents is None:
+        path = _blob_path(layout.directory_of(stamp), digest)
+        try:
+            with open(path, "rb") as blob:
+                contents = blob.read()
+        except (IOError, OSError):
+            raise MissingBlobError("""Blob {} named by {} has been """
+                                   """removed.""".format(digest, stamp))
+
+        _remember(digest, contents)
+
+    return pickle.loads(contents)
+
+
+def _referenced_digest(stamp):
+    """Return digest of the blob named by stamp, or None."""
+    try:
+        with open(stamp, "rb") as stamp_file:
+            header = stamp_file.read(len(MAGIC) + _DIGEST_LENGTH)
+    except (IOError, OSError):
+        return None
+
+    if not header.startswith(MAGIC):
+        return None
+
+    return header[len(MAGIC):].decode("ascii")
+
+
+def copy_referenced(stamp, directory):
+    """Copy the blob named by stamp, if any, into directory."""
+    digest = _referenced_digest(stamp)
+    if digest is None:
+        return
+
+    destination = _blob_path(directory, digest)
+    if os.path.exists(destination):
+        return
+
+    with open(_blob_path(layout.directory_of(stamp), digest), "rb") as blob:
+        contents = blob.read()
+
+    fileutil.safe_mkdir(os.path.dirname(destination))
+    fileutil.write_atomically(destination, contents)
+
+
+def collect(directory, grace=3600):
+    """Remove blobs in directory not named by any stamp.
+
+    Blobs written or reused in the last grace seconds are kept. Return
+    a (blobs removed, bytes freed) pair.
+    """
+    referenced = set()
+    for root, files in layout.walk(directory):
+        for name in files:
+            if not name.startswith(".") and "." not in name:
+                referenced.add(_referenced_digest(os.path.join(root, name)))
+
+    removed = 0
+    freed = 0
+    cutoff = time.time() - grace
+    for root, _, files in os.walk(os.path.join(directory, DIRECTORY)):
+        for name in files:
+            if name.startswith(".") or name in referenced:
+                continue
+
+            path = os.path.join(root, name)
+            try:
+                stat_result = os.stat(path)
+                if stat_result.st_mtime >= cutoff:
+                    continue
+
+                os.remove(path)
+            except OSError:
+                continue
+
+            removed += 1
+            freed += stat_result.st_size
+
+    return removed, freed
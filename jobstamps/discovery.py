@@ -0,0 +1,154 @@
+# /jobstamps/discovery.py
+#
+# Discovery of the files and directories read by a job.
+#
+# A single audit hook is installed the first time discovery is used,
+# since audit hooks cannot be removed. It forwards open, os.listdir and
+# os.scandir events raised on a thread to the recorders active on that
+# thread.
+#
+# Only reads are audited, so checks made without reading a file, such
+# as os.stat or os.path.exists, are not seen. A job which chooses between
+# files that way must declare the files it checks as dependencies. Files
+# which a job tried to read but which did not exist are recorded, so
+# that the job is re-run if one of them is created.
+#
+# See /LICENCE.md for Copyright information
+"""Discovery of the files and directories read by a job."""
+
+import os
+
+import sys
+
+import threading
+
+_ACTIVE = threading.local()
+_INSTALL_LOCK = threading.Lock()
+_INSTALLED = list()
+
+_ACCESS_MODE_MASK = getattr(os, "O_ACCMODE", os.O_RDONLY |
+                            os.O_WRONLY |
+                            os.O_RDWR)
+
+
+def _active_recorders():
+    """Return list of recorders active on this thread."""
+    try:
+        return _ACTIVE.recorders
+    except AttributeError:
+        _ACTIVE.recorders = list()
+        return _ACTIVE.recorders
+
+
+def _absolute_path(path):
+    """Return path as an absolute str, or None if it is a descriptor."""
+    if path is None:
+        path = os.curdir
+
+    if isinstance(path, int):
+        return None
+
+    path = os.fspath(path)
+    if isinstance(path, bytes):
+        path = os.fsdecode(path)
+
+    return os.path.abspath(path)
+
+
+def _open_access(mode, flags):
+    """Return a (reads, writes) pair for a file opened with mode or flags."""
+    if mode is None:
+        access = flags & _ACCESS_MODE_MASK
+        return access != os.O_WRONLY, access != os.O_RDONLY
+
+    return ("r" in mode or "+" in mode,
+            any(c in mode for c in "wax+"))
+
+
+def _audit_hook(event, args):
+    """Forward file and directory reads to active recorders."""
+    recorders = _active_recorders()
+    if not recorders:
+        return
+
+    if event == "open":
+        path = _absolute_path(args[0])
+        if path is None:
+            return
+
+        reads, writes = _open_access(args[1], args[2])
+        for recorder in recorders:
+            recorder.record(path, reads, writes)
+    elif event in ("os.listdir", "os.scandir"):
+        path = _absolute_path(args[0])
+        if path is None:
+            return
+
+        for recorder in recorders:
+            recorder.record(path, True, False)
+
+
+def _install():
+    """Install the audit hook, if it has not been installed already."""
+    if not hasattr(sys, "addaudithook"):
+        raise RuntimeError("""Discovering dependencies requires """
+                           """audit hooks, which are not available """
+                           """on this version of Python.""")
+
+    with _INSTALL_LOCK:
+        if not _INSTALLED:
+            sys.addaudithook(_audit_hook)
+            _INSTALLED.append(True)
+
+
+class DependencyRecorder(object):
+    """Context manager recording paths read on this thread while active.
+
+    Only reads made on the thread which entered the recorder are
+    recorded. Paths which were also written to are not considered to be
+    dependencies, since they are most likely outputs or temporary files.
+    Paths which were read but do not exist once the recorder has exited
+    are returned by absent instead of dependencies.
+    """
+
+    def __init__(self):
+        """Initialize sets of read and written paths."""
+        super(DependencyRecorder, self).__init__()
+        self._read = set()
+        self._written = set()
+
+    def __enter__(self):
+        """Start recording reads on this thread."""
+        _install()
+        _active_recorders().append(self)
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        """Stop recording reads on this thread."""
+        del exc_type
+        del value
+        del traceback
+
+        _active_recorders().remove(self)
+
+    def record(self, path, reads, writes):
+        """Record that path was read or written."""
+        if reads:
+            self._read.add(path)
+
+        if writes:
+            self._written.add(path)
+
+    def dependencies(self):
+        """Return sorted list of paths which were read and still exist."""
+        return sorted(p for p in self._read - self._written
+                      if os.path.exists(p))
+
+    def absent(self):
+        """Return sorted list of paths which were read but do not exist.
+
+        These are usually files which the job looked for and did not find,
+        such as optional configuration files.
+        """
+        return sorted(p for p in self._read - self._written
+                      if not os.path.exists(p))
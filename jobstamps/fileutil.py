@@ -0,0 +1,58 @@
+# /jobstamps/fileutil.py
+#
+# Helpers for writing files used by jobstamps safely.
+#
+# See /LICENCE.md for Copyright information
+"""Helpers for writing files used by jobstamps safely."""
+
+import errno
+
+import os
+
+import tempfile
+
+
+# The umask can only be read by setting it, so read it once up front rather
+# than racing with other threads each time a file is created.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def safe_mkdir(directory):
+    """Create a directory, ignoring errors if it already exists."""
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise error
+
+
+def replace_file(source, destination):
+    """Move source over destination, atomically where supported."""
+    getattr(os, "replace", os.rename)(source, destination)
+
+
+def temporary_file_beside(path):
+    """Return a (file object, name) pair for a new file beside path.
+
+    The file is created in the same directory as path, so that it can
+    later be moved over path with replace_file. Unlike the private file
+    mkstemp creates, it gets the mode open() would have given path.
+    """
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or
+                                             os.curdir,
+                                             prefix=".tmp")
+    os.chmod(temporary, 0o666 & ~_UMASK)
+    return os.fdopen(descriptor, "wb"), temporary
+
+
+def write_atomically(path, contents):
+    """Write contents to path, such that readers never see partial data."""
+    fileobj, temporary = temporary_file_beside(path)
+    try:
+        with fileobj:
+            fileobj.write(contents)
+        replace_file(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
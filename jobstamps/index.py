@@ -0,0 +1,108 @@
+# /jobstamps/index.py
+#
+# Reverse index from dependencies to the stamps which depend on them.
+#
+# Whenever a stamp for a job run with jobstamps_index is written, its
+# name is appended to a file for each of its dependencies, named after a
+# digest of the dependency's absolute path and stored in a hidden
+# subdirectory of the cache directory. Finding the stamps affected by a
+# set of changed files then only requires reading one file for each
+# changed file, rather than checking every stamp.
+#
+# Appending is atomic for records this small, so concurrent writers do
+# not need to coordinate. A name is only appended if it is not already in
+# the file, so each file holds at most one line for each stamp. Names are
+# never removed from the index, so it may name stamps which no longer
+# depend on a file or no longer exist. Stamps which no longer exist are
+# left out of lookups.
+#
+# See /LICENCE.md for Copyright information
+"""Reverse index from dependencies to the stamps which depend on them."""
+
+import errno
+
+import hashlib
+
+import os
+
+from jobstamps import fileutil
+from jobstamps import layout
+
+DIRECTORY = ".jobstamps-index"
+
+
+def _index_path(directory, dependency):
+    """Return path to the index file for dependency in directory."""
+    digest = hashlib.sha1(os.path.abspath(dependency).encode("utf-8"))
+    name = digest.hexdigest()
+    return os.path.join(directory, DIRECTORY, name[:2], name)
+
+
+def _append(path, record):
+    """Append record to the file at path, creating it if necessary."""
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    try:
+        descriptor = os.open(path, flags, 0o666)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+        fileutil.safe_mkdir(os.path.dirname(path))
+        descriptor = os.open(path, flags, 0o666)
+
+    try:
+        os.write(descriptor, record)
+    finally:
+        os.close(descriptor)
+
+
+def _read_names(path):
+    """Return set of names in the index file at path."""
+    try:
+        with open(path, "rb") as index_file:
+            return set(index_file.read().decode("utf-8").split())
+    except (IOError, OSError):
+        return set()
+
+
+def record(directory, name, dependencies):
+    """Record that the stamp called name in directory has dependencies."""
+    line = (name + "\n").encode("utf-8")
+    for dependency in set(dependencies):
+        path = _index_path(directory, dependency)
+        if name not in _read_names(path):
+            _append(path, line)
+
+
+def affected(directory, changed):
+    """Return sorted names of stamps in directory depending on changed.
+
+    changed is a list of paths to files which have changed. Relative
+    paths are taken to be relative to the current directory. Symbolic
+    links are not resolved, so the paths must be given in the same way
+    as the dependencies were.
+    """
+    names = set()
+    for path in changed:
+        names.update(_read_names(_index_path(directory, path)))
+
+    return sorted(n for n in names
+                  if os.path.exists(layout.find_stamp(directory, n)))
+
+
+def invalidate(directory, changed):
+    """Remove stamps in directory depending on changed, returning names.
+
+    The jobs for the removed stamps are re-run the next time they are run.
+    """
+    names = affected(directory, changed)
+    for name in names:
+        stamp = layout.find_stamp(directory, name)
+        for suffix in ("",) + layout.SIDECAR_SUFFIXES:
+            try:
+                os.remove(stamp + suffix)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+    return names
@@ -5,10 +5,16 @@
 # See /LICENCE.md for Copyright information
 """Main module for jobstamps."""
 
-import errno
+import atexit
+
+import functools
 
 import hashlib
 
+import inspect
+
+import io
+
 import json
 
 import os
@@ -17,45 +23,549 @@ import pickle
 
 import tempfile
 
-from collections import namedtuple
+import threading
+
+import time
+
+from collections import defaultdict, namedtuple
+
+from jobstamps import arrays
+from jobstamps import blobs
+from jobstamps import discovery
+from jobstamps import fileutil
+from jobstamps import index
+from jobstamps import layout
+from jobstamps import ledger
+from jobstamps import manifest
+from jobstamps import prefetch
+from jobstamps import tiers
+
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue  # suppress(import-error)
+
+
+class _StreamHeader(object):
+    """Marker stored at the start of a stamp holding a generator's items.
+
+    Each item follows the marker as a separate pickle record.
+    """
+
+    pass
+
+
+def _stamp(stampfile, dumped, blob_directory=None):
+    """Store a value in stampfile, as pickled by arrays.dumps.
+
+    dumped is the (pickled value, mapped arrays) pair returned by
+    arrays.dumps. Large NumPy arrays in the value are stored such that
+    they can be mapped into memory when the stamp is loaded. Otherwise, if
+    blob_directory is set, the pickled value is stored as a blob in that
+    directory, shared with any other stamp with the same value, and
+    stampfile names it.
+    """
+    pickled, mapped = dumped
+    if mapped:
+        arrays.write(stampfile, pickled, mapped)
+    elif blob_directory is not None:
+        fileutil.write_atomically(stampfile,
+                                  blobs.store(blob_directory, pickled))
+    else:
+        fileutil.write_atomically(stampfile, pickled)
+
+
+def _stream_to_stampfile(generator, stampfile, on_complete):
+    """Yield each item of generator, storing it in stampfile as it comes.
 
+    Items are written to a temporary file which is only moved into place
+    and followed by a call to on_complete once generator is exhausted. If
+    generator raises or is closed early, nothing is stored.
+    """
+    stamp, temporary = fileutil.temporary_file_beside(stampfile)
+    completed = False
 
-def _safe_mkdir(directory):
-    """Create a directory, ignoring errors if it already exists."""
     try:
-        os.makedirs(directory)
-    except OSError as error:
-        if error.errno != errno.EEXIST:
-            raise error
+        with stamp:
+            pickle.dump(_StreamHeader(), stamp, pickle.HIGHEST_PROTOCOL)
+            for item in generator:
+                pickle.dump(item, stamp, pickle.HIGHEST_PROTOCOL)
+                yield item
+
+        fileutil.replace_file(temporary, stampfile)
+        completed = True
+        on_complete()
+    finally:
+        if not completed:
+            os.remove(temporary)
+
 
+def _replay_stream(stamp):
+    """Yield each item stored after the _StreamHeader in stamp."""
+    with stamp:
+        while True:
+            try:
+                yield pickle.load(stamp)
+            except EOFError:
+                return
 
-def _stamp(stampfile, func, *args, **kwargs):
-    """Store the repr() of the return value of func in stampfile."""
-    value = func(*args, **kwargs)
-    with open(stampfile, "wb") as stamp:
-        stamp.truncate()
-        pickle.dump(value, stamp)
 
+def _load_stamp(stampfile):
+    """Return the value stored in stampfile.
+
+    If stampfile holds the items of a generator, a generator which
+    reads them incrementally is returned instead. Large NumPy arrays
+    are returned as read-only views of the stamp. If stampfile names a
+    blob which has been removed, blobs.MissingBlobError is raised.
+    """
+    contents = prefetch.contents(stampfile)
+    if contents is not None:
+        stamp = io.BytesIO(contents)
+    else:
+        stamp = open(stampfile, "rb")
+
+    try:
+        magic = stamp.read(len(arrays.MAGIC))
+        if magic == arrays.MAGIC:
+            with stamp:
+                return arrays.load(stamp, contents)
+
+        if magic == blobs.MAGIC:
+            with stamp:
+                return blobs.load(stampfile, stamp.read())
+
+        stamp.seek(0)
+        value = pickle.load(stamp)
+    except Exception:
+        stamp.close()
+        raise
+
+    if isinstance(value, _StreamHeader):
+        return _replay_stream(stamp)
+
+    stamp.close()
     return value
 
 
-def _stamp_and_update_hook(method,  # suppress(too-many-arguments)
-                           dependencies,
-                           stampfile,
-                           func,
-                           *args,
-                           **kwargs):
-    """Write stamp and call update_stampfile_hook on method."""
-    result = _stamp(stampfile, func, *args, **kwargs)
-    method.update_stampfile_hook(dependencies)
+class _StampWriter(object):
+    """Background thread which writes stamps queued for write-behind.
+
+    At most maxsize writes may be pending, after which queueing another
+    write blocks until one has completed. Pending writes are flushed when
+    the interpreter exits.
+    """
+
+    def __init__(self, maxsize):
+        """Initialize the queue. The thread is started on first use."""
+        super(_StampWriter, self).__init__()
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._errors = list()
+
+    def _work(self):
+        """Run each queued write, recording any errors."""
+        while True:
+            write = self._queue.get()
+            try:
+                write()
+            except Exception as error:  # suppress(broad-except)
+                self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def put(self, write):
+        """Queue the callable write to be run in the background."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work,
+                                                name="jobstamps-writer")
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+
+        self._queue.put(write)
+
+    def flush(self):
+        """Wait for all queued writes, re-raising the first error if any."""
+        if self._thread is None:
+            return
+
+        self._queue.join()
+        errors, self._errors = self._errors, list()
+        if errors:
+            raise errors[0]
+
+
+# Number of stamps which may be waiting to be written in the background
+# before run blocks.
+_WRITE_BEHIND_QUEUE_SIZE = 64
+
+_STAMP_WRITER = _StampWriter(_WRITE_BEHIND_QUEUE_SIZE)
+
+
+def flush():
+    """Wait until all stamps queued with jobstamps_write_behind are written.
+
+    The run and hit counts pending in the ledger are then written. If
+    writing any of the stamps failed, the first error is raised.
+    """
+    try:
+        _STAMP_WRITER.flush()
+    finally:
+        ledger.flush()
+
+
+def _snapshot_dependencies(detail):
+    """Return snapshot of dependencies in detail if writing behind."""
+    if detail.write_behind:
+        return detail.method.snapshot_dependencies(detail.dependencies)
+
+    return None
+
+
+def _discovered_dependencies_path(stampfile):
+    """Return path to file listing dependencies discovered for stampfile."""
+    return "{}.deps".format(stampfile)
+
+
+def _merge_dependencies(declared, discovered):
+    """Return declared followed by those of discovered not in declared."""
+    declared_set = set(declared)
+    return list(declared) + [d for d in discovered if d not in declared_set]
+
+
+def _with_discovered_dependencies(declared, stampfile):
+    """Return dependencies and absent dependencies discovered for stampfile.
+
+    The dependencies are those in declared followed by those discovered.
+    """
+    path = _discovered_dependencies_path(stampfile)
+    contents = prefetch.contents(path)
+    if contents is None:
+        try:
+            with open(path, "rb") as deps:
+                contents = deps.read()
+        except (IOError, OSError):
+            return list(declared), list()
+
+    discovered = json.loads(contents.decode("utf-8"))
+
+    # Stamps written before absent dependencies were recorded only list
+    # the dependencies which exist.
+    if isinstance(discovered, list):
+        return _merge_dependencies(declared, discovered), list()
+
+    return (_merge_dependencies(declared, discovered["dependencies"]),
+            discovered["absent"])
+
+
+def _record_discovered_dependencies(detail, recorder, snapshot=None):
+    """Return detail with dependencies discovered by recorder.
+
+    The dependencies in detail are set to those declared followed by
+    those recorded, and the absent dependencies to those which recorder
+    saw the job try to read but which do not exist. If snapshot is passed,
+    it is updated with a snapshot of any recorded dependency not already
+    in it.
+    """
+    dependencies = _merge_dependencies(detail.declared_dependencies,
+                                       recorder.dependencies())
+    if snapshot is not None:
+        snapshot.update(detail.method.snapshot_dependencies([
+            d for d in dependencies if d not in snapshot
+        ]))
+
+    return detail._replace(dependencies=dependencies,
+                           absent_dependencies=recorder.absent())
+
+
+def _write_stamp(detail, dumped, snapshot=None, cost=None):
+    """Write a result to the stamp in detail and update the method's records.
+
+    dumped is the result as pickled by arrays.dumps. The stamp is written
+    before the method's records, so that a reader never sees new records
+    alongside an old stamp. If cost is passed, it is a (job, arguments,
+    duration) tuple which is recorded in the ledger if it is in use.
+    """
+    _stamp(detail.stamp,
+           dumped,
+           detail.directory if detail.deduplicate else None)
+
+    if detail.declared_dependencies is not None:
+        discovered = json.dumps({
+            "dependencies": detail.dependencies,
+            "absent": detail.absent_dependencies
+        }).encode("utf-8")
+        fileutil.write_atomically(_discovered_dependencies_path(detail.stamp),
+                                  discovered)
+
+    detail.method.update_stampfile_hook(detail.dependencies, snapshot)
+    if detail.indexed:
+        index.record(detail.directory,
+                     os.path.basename(detail.stamp),
+                     detail.dependencies + detail.absent_dependencies)
+
+    if cost is not None and detail.ledger:
+        ledger.record_run(detail.stamp, *cost)
+
+    if detail.cache is not None:
+        detail.cache.replicate(detail.stamp, layout.SIDECAR_SUFFIXES)
+
+
+def _persist_stamp(detail, result, snapshot=None, cost=None):
+    """Write result to the stamp in detail, in the background if requested.
+
+    result is always pickled on the calling thread, so that changes made
+    to it by the caller after the job returns are not stored.
+    """
+    dumped = arrays.dumps(result,
+                          pickle.HIGHEST_PROTOCOL,
+                          copy=detail.write_behind)
+    if detail.write_behind:
+        _STAMP_WRITER.put(functools.partial(_write_stamp,
+                                            detail,
+                                            dumped,
+                                            snapshot,
+                                            cost))
+    else:
+        _write_stamp(detail, dumped, snapshot, cost)
+
+
+def _finish_stream(detail, snapshot, job, arguments, started):
+    """Update the method's records and ledger once a stream is stored."""
+    detail.method.update_stampfile_hook(detail.dependencies, snapshot)
+    if detail.indexed:
+        index.record(detail.directory,
+                     os.path.basename(detail.stamp),
+                     detail.dependencies + detail.absent_dependencies)
+
+    if detail.ledger:
+        ledger.record_run(detail.stamp,
+                          job,
+                          arguments,
+                          time.time() - started)
+
+    if detail.cache is not None:
+        detail.cache.replicate(detail.stamp, layout.SIDECAR_SUFFIXES)
+
+
+def _stamp_and_update_hook(detail, func, *args, **kwargs):
+    """Write stamp and call update_stampfile_hook on method.
+
+    If func returns a generator, a generator which stores each item as it
+    is produced is returned and the hook is called once it is exhausted.
+
+    If dependencies are being discovered, the paths read by func are
+    recorded and stored alongside those which were declared.
+
+    If the ledger is in use, the time taken by func is recorded in it. For
+    generators, this is the time taken until the generator is exhausted.
+    """
+    # Generator functions are rejected before they run. Other callables
+    # can only be seen to return generators once they have been called.
+    if (detail.declared_dependencies is not None and
+            inspect.isgeneratorfunction(func)):
+        raise ValueError("""Dependencies cannot be discovered for """
+                         """jobs which return generators.""")
+
+    _ensure_cache_directory(os.path.dirname(detail.stamp))
+    snapshot = _snapshot_dependencies(detail)
+    arguments = ledger.describe_arguments(args)
+    started = time.time()
+
+    if detail.declared_dependencies is None:
+        result = func(*args, **kwargs)
+    else:
+        with discovery.DependencyRecorder() as recorder:
+            result = func(*args, **kwargs)
+
+        if inspect.isgenerator(result):
+            raise ValueError("""Dependencies cannot be discovered for """
+                             """jobs which return generators.""")
+
+        detail = _record_discovered_dependencies(detail, recorder, snapshot)
+
+    if inspect.isgenerator(result):
+        return _stream_to_stampfile(result,
+                                    detail.stamp,
+                                    functools.partial(_finish_stream,
+                                                      detail,
+                                                      snapshot,
+                                                      func.__name__,
+                                                      arguments,
+                                                      started))
+
+    _persist_stamp(detail,
+                   result,
+                   snapshot,
+                   (func.__name__, arguments, time.time() - started))
     return result
 
 
+def _stat_or_none(path):
+    """Return os.stat result for path, or None if it cannot be stat'd."""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+# Only Windows returns file attributes with directory entries. Elsewhere,
+# DirEntry.stat() makes the same system call as os.stat, so scanning the
+# directory as well would only add work.
+_SCAN_DIRECTORIES = os.name == "nt" and hasattr(os, "scandir")
+
+
+def _stat_directory_group(directory, names):
+    """Return a dict of name to stat result for names in directory.
+
+    On Windows, a single os.scandir call is used to enumerate the
+    directory, which is cheaper than looking up each name separately.
+    Elsewhere, each name is looked up separately. Names which do not exist
+    in directory are absent from the returned dict.
+
+    Names which are not found by the scan are looked up separately, since
+    on case-insensitive filesystems they may be spelled differently from
+    the entry they name.
+    """
+    if len(names) == 1 or not _SCAN_DIRECTORIES:
+        return {n: _stat_or_none(os.path.join(directory, n)) for n in names}
+
+    wanted = set(names)
+    stats = dict()
+
+    try:
+        for entry in os.scandir(directory):
+            if entry.name in wanted:
+                try:
+                    stats[entry.name] = entry.stat()
+                except OSError:
+                    continue
+    except OSError:
+        return stats
+
+    for name in wanted.difference(stats):
+        stat_result = _stat_or_none(os.path.join(directory, name))
+        if stat_result is not None:
+            stats[name] = stat_result
+
+    return stats
+
+
+def _group_paths_by_directory(paths):
+    """Return a dict of directory to list of names for each path.
+
+    Paths which don't name a directory entry (for instance, those with
+    a trailing separator) are placed in the None group.
+    """
+    groups = defaultdict(list)
+    for path in paths:
+        directory, name = os.path.split(path)
+        if name in ("", os.curdir, os.pardir):
+            groups[None].append(path)
+        else:
+            groups[directory or os.curdir].append(name)
+
+    return groups
+
+
+def _stat_paths_grouped(paths, executor_map):
+    """Yield stat results for paths, enumerating each directory once."""
+    groups = _group_paths_by_directory(paths)
+    ungrouped = set(groups.pop(None, list()))
+    directories = list(groups.keys())
+    stats_for_directory = dict(zip(directories,
+                                   executor_map(_stat_directory_group,
+                                                directories,
+                                                [groups[d] for d
+                                                 in directories])))
+
+    for path in paths:
+        if path in ungrouped:
+            yield _stat_or_none(path)
+        else:
+            directory, name = os.path.split(path)
+            yield stats_for_directory[directory or os.curdir].get(name)
+
+
+# Thread pools used to stat dependencies, by number of workers. They are
+# created on first use and shared by every later check, since starting
+# a pool costs more than the stat calls it saves for most jobs.
+_STAT_EXECUTORS = dict()
+_STAT_EXECUTORS_LOCK = threading.Lock()
+
+
+def _stat_executor(workers):
+    """Return the shared thread pool with workers threads."""
+    with _STAT_EXECUTORS_LOCK:
+        if workers not in _STAT_EXECUTORS:
+            _STAT_EXECUTORS[workers] = futures.ThreadPoolExecutor(
+                max_workers=workers
+            )
+
+        return _STAT_EXECUTORS[workers]
+
+
+def _stat_paths(paths, workers=None, group_by_directory=False):
+    """Yield an os.stat result, or None if it does not exist, for each path.
+
+    Results are yielded in the same order as paths. If workers is greater
+    than one, stat calls are issued concurrently on a thread pool, which
+    hides latency on network filesystems. Otherwise, they are issued
+    serially. If group_by_directory is set, paths which share a directory
+    are looked up together, with a single os.scandir on Windows.
+    """
+    if workers is None or workers <= 1 or futures is None:
+        executor_map = map
+    else:
+        executor_map = _stat_executor(workers).map
+
+    if group_by_directory:
+        results = _stat_paths_grouped(paths, executor_map)
+    else:
+        results = executor_map(_stat_or_none, paths)
+
+    for stat_result in results:
+        yield stat_result
+
+
+def _stat_signature(stat_result):
+    """Return a tuple which changes when the file in stat_result changes.
+
+    If stat_result is None, the file did not exist and None is returned.
+    """
+    if stat_result is None:
+        return None
+
+    return (getattr(stat_result, "st_mtime_ns", stat_result.st_mtime),
+            stat_result.st_size,
+            stat_result.st_ino)
+
+
+def _snapshot_stat_signatures(dependencies):
+    """Return a dict of each of dependencies to its stat signature."""
+    return {d: _stat_signature(s) for d, s
+            in zip(dependencies, _stat_paths(dependencies))}
+
+
 def _sha1_for_file(filename):
-    """Return sha1 for contents of filename."""
+    """Return raw sha1 digest for contents of filename.
+
+    If filename is a directory, the digest is of its sorted entries.
+    """
+    if os.path.isdir(filename):
+        entries = "\0".join(sorted(os.listdir(filename)))
+        return hashlib.sha1(entries.encode("utf-8")).digest()
+
     with open(filename, "rb") as fileobj:
         contents = fileobj.read()
-        return hashlib.sha1(contents).hexdigest()
+        return hashlib.sha1(contents).digest()
 
 
 class MTimeMethod(object):
@@ -64,38 +574,73 @@ class MTimeMethod(object):
     def __init__(self, stamp_file_path):
         """Initialize and store mtime of stamp_file_path."""
         super(MTimeMethod, self).__init__()
-        if os.path.exists(stamp_file_path):
-            self._stamp_file_mtime = os.path.getmtime(stamp_file_path)
+        self._stamp_file_path = stamp_file_path
+        stamp_file_stat = _stat_or_none(stamp_file_path)
+        if stamp_file_stat is not None:
+            self._stamp_file_mtime = stamp_file_stat.st_mtime
         else:
             self._stamp_file_mtime = 0
 
-    def check_dependency(self, dependency_path):
-        """Check if mtime of dependency_path is greater than stored mtime."""
-        return os.path.getmtime(dependency_path) <= self._stamp_file_mtime
+    def check_dependency(self, dependency_path, stat_result=None):
+        """Check if mtime of dependency_path is greater than stored mtime.
+
+        If stat_result is passed, it is used instead of statting
+        dependency_path again.
+        """
+        if stat_result is None:
+            stat_result = os.stat(dependency_path)
+
+        return stat_result.st_mtime <= self._stamp_file_mtime
+
+    def snapshot_dependencies(self, dependencies):  # suppress(no-self-use)
+        """Return a snapshot of the stat signature of each dependency."""
+        return _snapshot_stat_signatures(dependencies)
+
+    def update_stampfile_hook(self, dependencies, snapshot=None):
+        """Mark the stamp out of date if dependencies changed since snapshot.
+
+        When the stamp is written after the job has finished, its mtime
+        would otherwise be newer than dependencies which were modified
+        while the job was running.
+        """
+        if snapshot is None:
+            return
 
-    def update_stampfile_hook(self, dependencies):  # suppress(no-self-use)
-        """Perform nothing."""
-        del dependencies
+        if any(_stat_signature(_stat_or_none(d)) != snapshot[d]
+               for d in dependencies):
+            os.utime(self._stamp_file_path, (0, 0))
 
 
 class HashMethod(object):
     """Method to verify if dependencies are up to date using a hash."""
 
     def __init__(self, stamp_file_path):
-        """Initialize and store filenames for hash files."""
+        """Initialize and store filenames for hash files.
+
+        The stored hashes are not loaded until they are first needed.
+        """
         super(HashMethod, self).__init__()
         self._stamp_file_hashes_path = "{}.dep.sha1".format(stamp_file_path)
+        self._stamp_file_hashes = None
 
-        if os.path.exists(self._stamp_file_hashes_path):
-            with open(self._stamp_file_hashes_path, "r") as hashes_file:
-                hashes_contents = hashes_file.read()
-                self._stamp_file_hashes = json.loads(hashes_contents)
-        else:
-            self._stamp_file_hashes = dict()
+    def _stored_hashes(self):
+        """Load stored hashes on first use and return them."""
+        if self._stamp_file_hashes is None:
+            contents = prefetch.contents(self._stamp_file_hashes_path)
+            if contents is not None:
+                self._stamp_file_hashes = manifest.from_bytes(contents)
+            else:
+                self._stamp_file_hashes = manifest.load(
+                    self._stamp_file_hashes_path
+                )
+
+        return self._stamp_file_hashes
+
+    def check_dependency(self, dependency_path, stat_result=None):
+        """Check if hash of dependency_path matches the stored hash."""
+        del stat_result
 
-    def check_dependency(self, dependency_path):
-        """Check if mtime of dependency_path is greater than stored mtime."""
-        stored_hash = self._stamp_file_hashes.get(dependency_path)
+        stored_hash = self._stored_hashes().get(dependency_path)
 
         # This file was newly added, or we don't have a file
         # with stored hashes yet. Assume out of date.
@@ -104,12 +649,40 @@ class HashMethod(object):
 
         return stored_hash == _sha1_for_file(dependency_path)
 
-    def update_stampfile_hook(self, dependencies):  # suppress(no-self-use)
-        """Loop over all dependencies and store hash for each of them."""
-        hashes = {d: _sha1_for_file(d) for d in dependencies
-                  if os.path.exists(d)}
-        with open(self._stamp_file_hashes_path, "wb") as hashes_file:
-            hashes_file.write(json.dumps(hashes).encode("utf-8"))
+    def snapshot_dependencies(self, dependencies):  # suppress(no-self-use)
+        """Return a snapshot of the stat signature of each dependency."""
+        return _snapshot_stat_signatures(dependencies)
+
+    def update_stampfile_hook(self, dependencies, snapshot=None):
+        """Loop over all dependencies and store hash for each of them.
+
+        If snapshot is passed, only dependencies which have not changed
+        since it was taken are stored, so that a dependency modified while
+        the job was running is out of date on the next check.
+        """
+        if self._stamp_file_hashes is not None:
+            self._stamp_file_hashes.close()
+            self._stamp_file_hashes = None
+
+        if snapshot is None:
+            hashes = {d: _sha1_for_file(d) for d in dependencies
+                      if os.path.exists(d)}
+        else:
+            hashes = dict()
+            for dependency in dependencies:
+                if snapshot[dependency] is None:
+                    continue
+
+                try:
+                    digest = _sha1_for_file(dependency)
+                except (IOError, OSError):
+                    continue
+
+                signature = _stat_signature(_stat_or_none(dependency))
+                if signature == snapshot[dependency]:
+                    hashes[dependency] = digest
+
+        manifest.write(self._stamp_file_hashes_path, hashes)
 
 
 def _determine_method(user_method):
@@ -135,58 +708,231 @@ _JOBSTAMPS_KWARGS_DESCRIPTIONS = """
                        date. By default, MTimeMethod is used, but HashMethod
                        should be used if files are being copied around
                        without being changed substantively.
+    :jobstamps_stat_workers: Number of threads used to stat dependencies.
+                             By default, dependencies are stat'd serially.
+                             Pass a number greater than 1 to stat them on
+                             a shared thread pool.
+    :jobstamps_group_by_directory: If set, dependencies which share a
+                                   directory are looked up with a single
+                                   directory scan on Windows. Elsewhere,
+                                   this has no effect.
+    :jobstamps_write_behind: If set, the result of a job which was re-run is
+                             returned immediately and its stamp is written
+                             on a background thread. Call flush() to wait
+                             for pending stamps to be written.
+    :jobstamps_discover_dependencies: If set, the files and directories
+                                      read by the job while it runs are
+                                      recorded and used as dependencies
+                                      in addition to those declared.
+                                      Requires Python 3.8 or later.
+    :jobstamps_cache_tiers: A tiers.TieredCache in which to look up and
+                            store stamps instead of
+                            jobstamps_cache_output_directory.
+    :jobstamps_deduplicate: If set, the result is stored once in the cache
+                            directory for every job with an identical
+                            result, and the stamp only names it. Use
+                            blobs.collect to remove results no longer
+                            named by any stamp.
+    :jobstamps_index: If set, the stamp is recorded in the cache
+                      directory's index under each of its dependencies,
+                      so that index.invalidate can find it.
+    :jobstamps_ledger: If set, the time taken to run the job and the
+                       number of times its stamp is reused are recorded
+                       beside the stamp, for ledger.entries to report.
 """
 
 
+# If dependencies are being discovered, declared_dependencies holds only
+# those passed by the caller and dependencies also includes those which
+# were discovered. absent_dependencies holds files which the job tried to
+# read but which did not exist, which make the stamp out of date if they
+# are created. Otherwise, declared_dependencies is None and
+# absent_dependencies is empty. If the stamp is in a tiered cache, cache
+# is the tiers.TieredCache, otherwise None. directory is the cache
+# directory or tier which holds the stamp.
 _OutOfDateActionDetail = namedtuple("_OutOfDateActionDetail",
-                                    "stamp dependencies method kwargs")
+                                    "stamp dependencies method kwargs "
+                                    "write_behind declared_dependencies "
+                                    "cache directory deduplicate "
+                                    "indexed ledger absent_dependencies")
 
 
-def _out_of_date(func, *args, **kwargs):
-    """Return out of date file and detail to run job."""
-    storage_directory = os.path.join(tempfile.gettempdir(), "jobstamps")
-    stamp_input = "".join([func.__name__] +
-                          [repr(v) for v in args] +
-                          [repr(kwargs[k])
-                           for k in sorted(kwargs.keys())]).encode("utf-8")
+# Options parsed from jobstamps_* keyword arguments.
+_JobOptions = namedtuple("_JobOptions",
+                         "dependencies output_files cache_output_directory "
+                         "method_class discover stat_workers "
+                         "group_by_directory write_behind cache "
+                         "deduplicate indexed ledger")
 
-    dependencies = kwargs.pop("jobstamps_dependencies", None) or list()
-    expected_output_files = (kwargs.pop("jobstamps_output_files", None) or
-                             list())
-    cache_output_directory = kwargs.pop("jobstamps_cache_output_directory",
-                                        None) or storage_directory
-    method_class = _determine_method(kwargs.pop("jobstamps_method", None))
-
-    stamp_file_name = os.path.join(cache_output_directory,
-                                   hashlib.md5(stamp_input).hexdigest())
 
-    detail = _OutOfDateActionDetail(stamp=stamp_file_name,
-                                    dependencies=dependencies,
-                                    method=method_class(stamp_file_name),
-                                    kwargs=kwargs)
+def default_cache_directory():
+    """Return the directory where stamp files are stored by default."""
+    return os.path.join(tempfile.gettempdir(), "jobstamps")
 
-    if os.environ.get("JOBSTAMPS_DISABLED", None):
-        return "JOBSTAMPS_DISABLED", detail
 
-    _safe_mkdir(cache_output_directory)
+def _ensure_cache_directory(cache_output_directory):
+    """Create cache_output_directory, raising if it is not a directory."""
+    fileutil.safe_mkdir(cache_output_directory)
 
     if not os.path.isdir(cache_output_directory):
         raise IOError("""{} exists and is """
                       """not a directory.""".format(cache_output_directory))
 
-    if not os.path.exists(stamp_file_name):
-        return stamp_file_name, detail
+
+def _check_stamp(detail,
+                 expected_output_files,
+                 stat_workers=None,
+                 group_by_directory=False):
+    """Return the first file which makes the stamp in detail out of date.
+
+    If nothing is out of date, return None.
+    """
+    if not os.path.exists(detail.stamp):
+        return detail.stamp
 
     for expected_output_file in expected_output_files:
         if not os.path.exists(expected_output_file):
-            return expected_output_file, detail
+            return expected_output_file
+
+    dependency_stats = _stat_paths(detail.dependencies,
+                                   workers=stat_workers,
+                                   group_by_directory=group_by_directory)
+    for dependency, stat_result in zip(detail.dependencies,
+                                       dependency_stats):
+        if (stat_result is None or
+                not detail.method.check_dependency(dependency, stat_result)):
+            return dependency
+
+    for absent_dependency in detail.absent_dependencies:
+        if os.path.exists(absent_dependency):
+            return absent_dependency
 
-    for dependency in dependencies:
-        if (not os.path.exists(dependency) or
-                not detail.method.check_dependency(dependency)):
-            return dependency, detail
+    return None
 
-    return None, detail
+
+def _pop_check_options(kwargs):
+    """Pop options which do not affect the stamp name from kwargs.
+
+    These options only affect how dependencies are checked and stamps
+    are written, so they are removed before the stamp name is computed.
+    They are returned as a dict, to be passed to _pop_job_options.
+    """
+    return {
+        "stat_workers": kwargs.pop("jobstamps_stat_workers", None),
+        "group_by_directory": kwargs.pop("jobstamps_group_by_directory",
+                                         False),
+        "write_behind": kwargs.pop("jobstamps_write_behind", False),
+        "cache": kwargs.pop("jobstamps_cache_tiers", None),
+        "deduplicate": kwargs.pop("jobstamps_deduplicate", False),
+        "indexed": kwargs.pop("jobstamps_index", False),
+        "ledger": kwargs.pop("jobstamps_ledger", False)
+    }
+
+
+def _pop_job_options(kwargs, check_options):
+    """Pop the remaining jobstamps_* options from kwargs.
+
+    Return a _JobOptions including those in check_options.
+    """
+    dependencies = list(kwargs.pop("jobstamps_dependencies", None) or list())
+    output_files = list(kwargs.pop("jobstamps_output_files", None) or list())
+    cache_output_directory = (kwargs.pop("jobstamps_cache_output_directory",
+                                         None) or
+                              default_cache_directory())
+    method_class = _determine_method(kwargs.pop("jobstamps_method", None))
+    discover = kwargs.pop("jobstamps_discover_dependencies", False)
+
+    return _JobOptions(dependencies=dependencies,
+                       output_files=output_files,
+                       cache_output_directory=cache_output_directory,
+                       method_class=method_class,
+                       discover=discover,
+                       **check_options)
+
+
+def _locate_stamp(name, options, kwargs):
+    """Return out of date file and detail for the stamp called name."""
+    def _make_detail(directory):
+        """Return detail for the stamp called name in directory."""
+        stamp = layout.find_stamp(directory, name)
+        dependencies = options.dependencies
+        declared = None
+        absent = list()
+
+        if options.discover:
+            declared = dependencies
+            dependencies, absent = _with_discovered_dependencies(dependencies,
+                                                                 stamp)
+
+        return _OutOfDateActionDetail(stamp=stamp,
+                                      dependencies=dependencies,
+                                      method=options.method_class(stamp),
+                                      kwargs=kwargs,
+                                      write_behind=options.write_behind,
+                                      declared_dependencies=declared,
+                                      cache=options.cache,
+                                      directory=directory,
+                                      deduplicate=options.deduplicate,
+                                      indexed=options.indexed,
+                                      ledger=options.ledger,
+                                      absent_dependencies=absent)
+
+    def _check(detail):
+        """Return the first file which makes detail out of date."""
+        return _check_stamp(detail,
+                            options.output_files,
+                            stat_workers=options.stat_workers,
+                            group_by_directory=options.group_by_directory)
+
+    disabled = os.environ.get("JOBSTAMPS_DISABLED", None)
+
+    if options.cache is None:
+        detail = _make_detail(options.cache_output_directory)
+        if disabled:
+            return "JOBSTAMPS_DISABLED", detail
+
+        return _check(detail), detail
+
+    if disabled:
+        return ("JOBSTAMPS_DISABLED",
+                _make_detail(options.cache.available_tiers()[0].directory))
+
+    return options.cache.locate(_make_detail,
+                                _check,
+                                layout.SIDECAR_SUFFIXES)
+
+
+def _job_key(func, args, kwargs):
+    """Return name of stamp for func called with args and kwargs.
+
+    Options which do not affect the stamp name must already have been
+    removed from kwargs.
+    """
+    stamp_input = "".join([func.__name__] +
+                          [repr(v) for v in args] +
+                          [repr(kwargs[k])
+                           for k in sorted(kwargs.keys())]).encode("utf-8")
+    return hashlib.md5(stamp_input).hexdigest()
+
+
+def _out_of_date(func, *args, **kwargs):
+    """Return out of date file and detail to run job."""
+    check_options = _pop_check_options(kwargs)
+    name = _job_key(func, args, kwargs)
+    options = _pop_job_options(kwargs, check_options)
+    return _locate_stamp(name, options, kwargs)
+
+
+def job_key(func, *args, **kwargs):  # suppress(unused-function)
+    """Return name of the stamp which run would use for this job.
+
+    This can be passed to prefetch.load_directory or prefetch.pack to load
+    only the stamps for particular jobs.
+
+    {kwargs_description}
+    """.format(kwargs_description=_JOBSTAMPS_KWARGS_DESCRIPTIONS)
+    _pop_check_options(kwargs)
+    return _job_key(func, args, kwargs)
 
 
 def out_of_date(func, *args, **kwargs):  # suppress(unused-function)
@@ -202,12 +948,8 @@ def out_of_date(func, *args, **kwargs):  # suppress(unused-function)
     return _out_of_date(func, *args, **kwargs)[0]
 
 
-def run(func, *args, **kwargs):
-    """Run a job, re-using the cached result if not out of date.
-
-    {kwargs_description}
-    """.format(kwargs_description=_JOBSTAMPS_KWARGS_DESCRIPTIONS)
-    trigger, detail = _out_of_date(func, *args, **kwargs)
+def _run_with_detail(func, args, trigger, detail):
+    """Run func if trigger is set, otherwise return the stamped result."""
     jobstamps_debug = os.environ.get("JOBSTAMPS_DEBUG", None)
 
     if trigger:
@@ -219,12 +961,7 @@ def run(func, *args, **kwargs):
         if os.environ.get("JOBSTAMPS_DISABLED", None):
             return func(*args, **detail.kwargs)
 
-        return _stamp_and_update_hook(detail.method,
-                                      detail.dependencies,
-                                      detail.stamp,
-                                      func,
-                                      *args,
-                                      **detail.kwargs)
+        return _stamp_and_update_hook(detail, func, *args, **detail.kwargs)
 
     # It is safe to re-use the cached value, open the stampfile
     # and return its contents
@@ -233,5 +970,201 @@ def run(func, *args, **kwargs):
               """using cached value of {} from {}""".format(func.__name__,
                                                             detail.stamp))
 
-    with open(detail.stamp, "rb") as stamp:
-        return pickle.load(stamp)
+    if detail.ledger:
+        ledger.record_hit(detail.stamp)
+
+    try:
+        if detail.cache is not None:
+            return detail.cache.load(detail.stamp, _load_stamp)
+
+        return _load_stamp(detail.stamp)
+    except blobs.MissingBlobError:
+        return _stamp_and_update_hook(detail, func, *args, **detail.kwargs)
+
+
+def run(func, *args, **kwargs):
+    """Run a job, re-using the cached result if not out of date.
+
+    If func returns a generator, each item is stored as it is produced
+    and the job is only considered up to date once the generator is
+    exhausted. A cached result is then returned as a generator which reads
+    items back as they are consumed.
+
+    {kwargs_description}
+    """.format(kwargs_description=_JOBSTAMPS_KWARGS_DESCRIPTIONS)
+    trigger, detail = _out_of_date(func, *args, **kwargs)
+    return _run_with_detail(func, args, trigger, detail)
+
+
+def _timed_call(func, item):
+    """Return (seconds taken, result) for func applied to item."""
+    started = time.time()
+    result = func(item)
+    return time.time() - started, result
+
+
+def _map_in_processes(func, items, processes=None):
+    """Return list of func applied to each of items, using processes.
+
+    A process pool is only used if there is more than one item and
+    processes is not 1, otherwise func is applied in this process.
+    """
+    if len(items) <= 1 or processes == 1 or futures is None:
+        return [func(item) for item in items]
+
+    with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(func, items))
+
+
+def run_map(func, items, dependencies_for=None, processes=None, **kwargs):
+    """Run a job for each of items, re-running only those out of date.
+
+    Each item is stamped as though it was run separately as
+    run(func, item, ...), with its dependencies being those in
+    jobstamps_dependencies followed by those returned by
+    dependencies_for(item). A change to a dependency in
+    jobstamps_dependencies therefore makes every item out of date.
+
+    Items which are out of date are run on a pool of processes, so func and
+    its results must be picklable. Pass processes=1 to run them in this
+    process instead. The results are returned as a list in the same order
+    as items.
+
+    {kwargs_description}
+    """.format(kwargs_description=_JOBSTAMPS_KWARGS_DESCRIPTIONS)
+    if kwargs.get("jobstamps_discover_dependencies", False):
+        raise ValueError("""Dependencies cannot be discovered for jobs """
+                         """run with run_map.""")
+
+    items = list(items)
+    shared_dependencies = list(kwargs.pop("jobstamps_dependencies", None) or
+                               list())
+
+    checks = list()
+    for item in items:
+        item_dependencies = list(shared_dependencies)
+        if dependencies_for:
+            item_dependencies.extend(dependencies_for(item))
+
+        item_kwargs = dict(kwargs)
+        item_kwargs["jobstamps_dependencies"] = item_dependencies
+        checks.append(_out_of_date(func, item, **item_kwargs))
+
+    stale = [i for i, (trigger, _) in enumerate(checks) if trigger]
+    disabled = os.environ.get("JOBSTAMPS_DISABLED", None)
+    if not disabled:
+        for directory in set(os.path.dirname(checks[i][1].stamp)
+                             for i in stale):
+            _ensure_cache_directory(directory)
+
+    snapshots = [_snapshot_dependencies(checks[i][1]) for i in stale]
+    stale_results = _map_in_processes(functools.partial(_timed_call, func),
+                                      [items[i] for i in stale],
+                                      processes=processes)
+
+    results = [None] * len(items)
+    for position, snapshot, (duration, result) in zip(stale,
+                                                      snapshots,
+                                                      stale_results):
+        if not disabled:
+            _persist_stamp(checks[position][1],
+                           result,
+                           snapshot,
+                           (func.__name__,
+                            ledger.describe_arguments((items[position],)),
+                            duration))
+
+        results[position] = result
+
+    for position, (trigger, detail) in enumerate(checks):
+        if not trigger:
+            if detail.ledger:
+                ledger.record_hit(detail.stamp)
+            try:
+                results[position] = _load_stamp(detail.stamp)
+            except blobs.MissingBlobError:
+                results[position] = _stamp_and_update_hook(detail,
+                                                           func,
+                                                           items[position])
+
+    return results
+
+
+def _update_code_digest(digest, code):
+    """Update digest with the bytecode, constants and names in code.
+
+    Code objects nested in code, such as those of inner functions, are
+    included. Filenames and line numbers are not, so moving a function
+    around does not change its digest.
+    """
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode("utf-8"))
+
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            _update_code_digest(digest, constant)
+        elif isinstance(constant, frozenset):
+            digest.update(repr(sorted(constant, key=repr)).encode("utf-8"))
+        else:
+            digest.update(repr(constant).encode("utf-8"))
+
+
+def _memoize_key_prefix(func):
+    """Return the part of a stamp name which is the same for every call.
+
+    This is the qualified name of func followed by a digest of its code
+    and default argument values, so that changing either of them results
+    in different stamps.
+    """
+    name = "{}.{}".format(getattr(func, "__module__", None),
+                          getattr(func, "__qualname__", func.__name__))
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return name
+
+    digest = hashlib.sha1()
+    _update_code_digest(digest, code)
+    digest.update(repr(getattr(func, "__defaults__", None)).encode("utf-8"))
+    digest.update(repr(getattr(func, "__kwdefaults__", None)).encode("utf-8"))
+    return "{}:{}".format(name, digest.hexdigest())
+
+
+def memoize(func=None, **kwargs):
+    """Decorate func such that its calls are cached as though made by run.
+
+    The jobstamps_* options are fixed when func is decorated, along with
+    the name of func and a digest of its code. Each call then only needs to
+    hash its arguments before checking the stamp. Because the digest of
+    the code of func is part of each stamp name, editing func means that
+    previously stored results are no longer used.
+
+    This can be used either as @memoize or with options, for instance
+    as @memoize(jobstamps_dependencies=["file"]).
+
+    {kwargs_description}
+    """.format(kwargs_description=_JOBSTAMPS_KWARGS_DESCRIPTIONS)
+    if func is None:
+        return lambda f: memoize(f, **kwargs)
+
+    options = _pop_job_options(kwargs, _pop_check_options(kwargs))
+
+    if kwargs:
+        raise TypeError("""Unknown options passed to """
+                        """memoize: {}""".format(", ".join(sorted(kwargs))))
+
+    key_prefix = _memoize_key_prefix(func)
+
+    @functools.wraps(func)
+    def _memoized(*args, **call_kwargs):
+        """Run func through the stamp computed from its arguments."""
+        # Unlike _job_key, the arguments are encoded as a single tuple, so
+        # that neither the boundaries between positional arguments nor the
+        # names of keyword arguments are lost.
+        stamp_input = repr((key_prefix,
+                            args,
+                            sorted(call_kwargs.items())))
+        name = hashlib.md5(stamp_input.encode("utf-8")).hexdigest()
+        trigger, detail = _locate_stamp(name, options, call_kwargs)
+        return _run_with_detail(func, args, trigger, detail)
+
+    return _memoized
@@ -13,11 +13,32 @@
 # The user may specify --stamp-directory to change the directory in which
 # cache files are stored.
 #
+# The cached result is shared by every invocation of the same executable
+# with the same arguments, wherever it is run from. Arguments naming
+# existing files are compared by their canonical paths. Use --cwd-sensitive
+# if the command's output depends on the working directory and --env to
+# name environment variables which its output depends on.
+#
+# Use --stdin to pass standard input to the command. Standard input is
+# read in full before the command is run and its digest forms part of the
+# key, so that cached output is only reused for the same input.
+#
+# Maintenance commands for stamp directories are run by passing the name
+# of the command as the first argument instead:
+#
+#     jobstamp migrate DIRECTORY [--layout {flat,sharded}]
+#     jobstamp pack DIRECTORY SNAPSHOT [--keys KEY [KEY ...]]
+#     jobstamp report DIRECTORY [--top N] [--sort {duration,saved,size}]
+#     jobstamp invalidate DIRECTORY --changed PATH [PATH ...] [--dry-run]
+#     jobstamp collect DIRECTORY [--grace SECONDS]
+#
 # See /LICENCE.md for Copyright information
 """Main entry point for the jobstamp command line utility."""
 
 import argparse
 
+import hashlib
+
 import os
 
 import shutil  # suppress(unused-import)
@@ -26,25 +47,140 @@ import subprocess
 
 import sys
 
+import tempfile
+
+from jobstamps import blobs
+from jobstamps import index
 from jobstamps import jobstamp
+from jobstamps import layout
+from jobstamps import ledger
+from jobstamps import prefetch
 
 import parseshebang
 
 import shutilwhich  # suppress(F401,unused-import)
 
 
-def _run_cmd(cmd):
-    """Run command specified by :cmd: and return stdout, stderr and code."""
-    if not os.path.exists(cmd[0]):
-        cmd[0] = shutil.which(cmd[0])
-        assert cmd[0] is not None
+_STDIN_CHUNK_SIZE = 1 << 16
+
+# Standard input beyond this many bytes is spooled to a temporary file.
+_STDIN_MEMORY_LIMIT = 1 << 20
+
+
+def _spool_stdin(stream):
+    """Return (hex digest, size, spool file) for the contents of stream.
+
+    Contents are read in chunks and kept in memory up to
+    _STDIN_MEMORY_LIMIT bytes, beyond which they are spooled to disk.
+    """
+    digest = hashlib.sha1()
+    spool = tempfile.SpooledTemporaryFile(max_size=_STDIN_MEMORY_LIMIT)
+    while True:
+        chunk = stream.read(_STDIN_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        digest.update(chunk)
+        spool.write(chunk)
+
+    size = spool.tell()
+    spool.seek(0)
+    return digest.hexdigest(), size, spool
+
+
+def _canonical_argument(argument):
+    """Return argument with any path to an existing file made canonical.
+
+    Both arguments which are paths and the values of arguments of the
+    form --option=path are made canonical.
+    """
+    if os.path.exists(argument):
+        return os.path.realpath(argument)
+
+    option, separator, value = argument.partition("=")
+    if separator and value and os.path.exists(value):
+        return option + separator + os.path.realpath(value)
+
+    return argument
+
+
+def _canonical_paths(paths):
+    """Return sorted list of canonical forms of paths, without duplicates."""
+    return sorted(set(os.path.realpath(p) for p in paths or list()))
 
-    shebang_parts = parseshebang.parse(cmd[0])
 
-    proc = subprocess.Popen(shebang_parts + cmd,
+def _environment_digest(variable):
+    """Return the digest of the value of variable, or None if it is unset."""
+    value = os.environ.get(variable, None)
+    if value is None:
+        return None
+
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8", "surrogateescape")
+
+    return hashlib.sha1(value).hexdigest()
+
+
+class _Command(object):
+    """A command to run, along with what its output depends on.
+
+    Stamps are named after the representation of the arguments to a job,
+    so the representation of this object only includes what determines
+    the output of the command: its executable, found on PATH if necessary,
+    its arguments, with paths made canonical, the working directory if
+    cwd_sensitive is set, the digest of the value of each environment
+    variable in env and the digest of the standard input passed to it, if
+    any. Values of environment variables are not stored directly, since
+    the key is recorded in the ledger.
+    """
+
+    def __init__(self, cmd, cwd_sensitive=False, env=None, stdin=None):
+        """Resolve the executable in cmd and compute the key.
+
+        If stdin is passed, it is a stream whose contents are passed to the
+        command as its standard input.
+        """
+        super(_Command, self).__init__()
+        if stdin is not None:
+            digest, self.stdin_size, self.stdin = _spool_stdin(stdin)
+        else:
+            digest, self.stdin_size, self.stdin = None, 0, None
+
+        executable = cmd[0]
+        if not os.path.exists(executable):
+            executable = shutil.which(executable)
+            assert executable is not None
+
+        # Symbolic links to the executable are not resolved, since some
+        # programs behave differently depending on the name they are run by.
+        self.argv = [os.path.abspath(executable)] + cmd[1:]
+        self.key = (self.argv[:1] +
+                    [_canonical_argument(a) for a in self.argv[1:]],
+                    os.path.realpath(os.getcwd()) if cwd_sensitive else None,
+                    [(v, _environment_digest(v))
+                     for v in sorted(set(env or list()))],
+                    digest)
+
+    def __repr__(self):
+        """Return representation of the key for this command."""
+        return repr(self.key)
+
+
+def _run_cmd(command):
+    """Run _Command :command: and return stdout, stderr and code."""
+    shebang_parts = parseshebang.parse(command.argv[0])
+
+    # Standard input held in memory is written to the command through a
+    # pipe, otherwise the command reads the spool file directly.
+    stdin, stdin_input = command.stdin, None
+    if stdin is not None and command.stdin_size <= _STDIN_MEMORY_LIMIT:
+        stdin, stdin_input = subprocess.PIPE, command.stdin.read()
+
+    proc = subprocess.Popen(shebang_parts + command.argv,
+                            stdin=stdin,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
+    stdout, stderr = proc.communicate(stdin_input)
     return {
         "stdout": stdout,
         "stderr": stderr,
@@ -52,6 +188,205 @@ def _run_cmd(cmd):
     }
 
 
+def _migrate_main(argv):
+    """Convert a stamp directory to another layout."""
+    parser = argparse.ArgumentParser(prog="jobstamp migrate",
+                                     description="""Convert a stamp """
+                                                 """directory to another """
+                                                 """layout, in place""")
+    parser.add_argument("directory",
+                        metavar="DIRECTORY",
+                        help="""The stamp directory to convert.""")
+    parser.add_argument("--layout",
+                        choices=(layout.FLAT, layout.SHARDED),
+                        default=layout.SHARDED,
+                        help="""The layout to convert to. In the sharded """
+                             """layout, stamps are stored in """
+                             """subdirectories, which is faster for very """
+                             """large stamp directories.""")
+    namespace = parser.parse_args(argv)
+
+    moved = layout.migrate(namespace.directory, namespace.layout)
+    sys.stdout.write("""Moved {} files.\n""".format(moved))
+    return 0
+
+
+def _pack_main(argv):
+    """Pack stamps in a stamp directory into a single snapshot file."""
+    parser = argparse.ArgumentParser(prog="jobstamp pack",
+                                     description="""Pack stamps into a """
+                                                 """snapshot file which """
+                                                 """can be loaded with """
+                                                 """--prefetch""")
+    parser.add_argument("directory",
+                        metavar="DIRECTORY",
+                        help="""The stamp directory to pack.""")
+    parser.add_argument("snapshot",
+                        metavar="SNAPSHOT",
+                        help="""The snapshot file to write.""")
+    parser.add_argument("--keys",
+                        metavar="KEY",
+                        nargs="*",
+                        help="""Only pack the stamps for these job keys. """
+                             """By default, every stamp is packed.""")
+    namespace = parser.parse_args(argv)
+
+    packed = prefetch.pack(namespace.directory,
+                           namespace.snapshot,
+                           names=namespace.keys)
+    sys.stdout.write("""Packed {} stamps.\n""".format(packed))
+    return 0
+
+
+_REPORT_SORT_KEYS = {
+    "duration": lambda e: e.duration,
+    "saved": ledger.time_saved,
+    "size": lambda e: e.size
+}
+
+
+def _job_rows(entries):
+    """Return list of (job, stamps, hit rate, time saved) for each job."""
+    by_job = dict()
+    for entry in entries:
+        by_job.setdefault(entry.job, list()).append(entry)
+
+    rows = [(job,
+             len(job_entries),
+             ledger.hit_rate(job_entries),
+             sum(ledger.time_saved(e) for e in job_entries))
+            for job, job_entries in by_job.items()]
+    return sorted(rows, key=lambda r: r[3], reverse=True)
+
+
+def _report_main(argv):
+    """Report what jobs in a stamp directory cost and how often reused."""
+    parser = argparse.ArgumentParser(prog="jobstamp report",
+                                     description="""Report the cost of """
+                                                 """jobs in a stamp """
+                                                 """directory and the time """
+                                                 """saved by reusing them""")
+    parser.add_argument("directory",
+                        metavar="DIRECTORY",
+                        help="""The stamp directory to report on.""")
+    parser.add_argument("--top",
+                        metavar="N",
+                        type=int,
+                        default=10,
+                        help="""The number of stamps to list.""")
+    parser.add_argument("--sort",
+                        choices=sorted(_REPORT_SORT_KEYS.keys()),
+                        default="duration",
+                        help="""How to order the listed stamps. By """
+                             """default, the stamps whose jobs took longest """
+                             """to run are listed first.""")
+    namespace = parser.parse_args(argv)
+
+    entries = ledger.entries(namespace.directory)
+    sys.stdout.write("""Stamps: {}  Runs: {}  Hits: {}  Hit rate: {:.1%}  """
+                     """Time saved: {:.2f}s\n""".format(
+                         len(entries),
+                         sum(e.runs for e in entries),
+                         sum(e.hits for e in entries),
+                         ledger.hit_rate(entries),
+                         sum(ledger.time_saved(e) for e in entries)
+                     ))
+
+    sys.stdout.write("""\n{:>10}  {:>6}  {:>6}  {:>10}  {:>10}  """
+                     """Job\n""".format("Duration", "Runs", "Hits",
+                                        "Saved", "Size"))
+    for entry in sorted(entries,
+                        key=_REPORT_SORT_KEYS[namespace.sort],
+                        reverse=True)[:namespace.top]:
+        sys.stdout.write("""{:>9.2f}s  {:>6}  {:>6}  {:>9.2f}s  {:>10}  """
+                         """{}{}\n""".format(entry.duration,
+                                             entry.runs,
+                                             entry.hits,
+                                             ledger.time_saved(entry),
+                                             entry.size,
+                                             entry.job,
+                                             entry.arguments))
+
+    header = """\n{:>6}  {:>8}  {:>10}  Job\n"""
+    sys.stdout.write(header.format("Stamps", "Hit rate", "Saved"))
+    for job, stamps, rate, saved in _job_rows(entries):
+        row = """{:>6}  {:>8.1%}  {:>9.2f}s  {}\n"""
+        sys.stdout.write(row.format(stamps, rate, saved, job))
+
+    return 0
+
+
+def _invalidate_main(argv):
+    """Remove stamps in a stamp directory which depend on changed files."""
+    parser = argparse.ArgumentParser(prog="jobstamp invalidate",
+                                     description="""Remove stamps which """
+                                                 """depend on changed """
+                                                 """files""")
+    parser.add_argument("directory",
+                        metavar="DIRECTORY",
+                        help="""The stamp directory to remove stamps """
+                             """from.""")
+    parser.add_argument("--changed",
+                        metavar="PATH",
+                        nargs="+",
+                        required=True,
+                        help="""Files which have changed. Stamps for jobs """
+                             """which depend on any of them are removed.""")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="""Only list the stamps which depend on the """
+                             """changed files, without removing them.""")
+    namespace = parser.parse_args(argv)
+
+    # Dependencies are recorded by their canonical paths, so changed files
+    # must be looked up in the same way.
+    changed = _canonical_paths(namespace.changed)
+    if namespace.dry_run:
+        names = index.affected(namespace.directory, changed)
+    else:
+        names = index.invalidate(namespace.directory, changed)
+
+    for name in names:
+        sys.stdout.write(name + "\n")
+
+    return 0
+
+
+def _collect_main(argv):
+    """Remove deduplicated results no longer used by any stamp."""
+    parser = argparse.ArgumentParser(prog="jobstamp collect",
+                                     description="""Remove deduplicated """
+                                                 """results which are no """
+                                                 """longer used by any """
+                                                 """stamp""")
+    parser.add_argument("directory",
+                        metavar="DIRECTORY",
+                        help="""The stamp directory to remove results """
+                             """from.""")
+    parser.add_argument("--grace",
+                        metavar="SECONDS",
+                        type=float,
+                        default=3600,
+                        help="""Keep results stored or reused within this """
+                             """many seconds, which may be about to be """
+                             """used by a job which is still running.""")
+    namespace = parser.parse_args(argv)
+
+    removed, freed = blobs.collect(namespace.directory, namespace.grace)
+    sys.stdout.write("""Removed {} results, freeing {} """
+                     """bytes.\n""".format(removed, freed))
+    return 0
+
+
+_COMMANDS = {
+    "collect": _collect_main,
+    "invalidate": _invalidate_main,
+    "migrate": _migrate_main,
+    "pack": _pack_main,
+    "report": _report_main
+}
+
+
 def main(argv=None):  # suppress(unused-function)
     """Entry point for jobstamp command.
 
@@ -61,6 +396,9 @@ def main(argv=None):  # suppress(unused-function)
     """
     argv = argv or sys.argv
 
+    if len(argv) > 1 and argv[1] in _COMMANDS:
+        return _COMMANDS[argv[1]](argv[2:])
+
     if "--" not in argv:
         sys.stderr.write("""Must specify command after '--'.\n""")
         return 1
@@ -98,19 +436,83 @@ def main(argv=None):  # suppress(unused-function)
                              """invocation of the job. This method is """
                              """slower, but can withstand files being """
                              """copied or moved.""")
+    parser.add_argument("--cwd-sensitive",
+                        action="store_true",
+                        help="""Only reuse the cached result of this """
+                             """command when it is run from the same """
+                             """working directory.""")
+    parser.add_argument("--env",
+                        metavar="VARIABLE",
+                        action="append",
+                        help="""An environment variable which the output """
+                             """of this command depends on. The cached """
+                             """result is only reused if it has the same """
+                             """value. May be passed more than once.""")
+    parser.add_argument("--stdin",
+                        action="store_true",
+                        help="""Pass standard input to this command. The """
+                             """cached result is only reused if standard """
+                             """input is the same, in which case the """
+                             """command is not started.""")
+    parser.add_argument("--deduplicate",
+                        action="store_true",
+                        help="""Store the output of this command once for """
+                             """every command with identical output.""")
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="""Record this command in the stamp """
+                             """directory's index under each of its """
+                             """dependencies, so that 'jobstamp """
+                             """invalidate' can find it.""")
+    parser.add_argument("--ledger",
+                        action="store_true",
+                        help="""Record the time taken to run this command """
+                             """and the number of times its cached result """
+                             """is reused, for 'jobstamp report'.""")
+    parser.add_argument("--prefetch",
+                        metavar="SNAPSHOT",
+                        type=str,
+                        help="""A snapshot of the stamp directory written """
+                             """by 'jobstamp pack', from which stamps are """
+                             """read instead of the stamp directory if """
+                             """they have not changed since.""")
     namespace = parser.parse_args(args)
     stamp_directory = namespace.stamp_directory
+
     if namespace.use_hashes:
         method = jobstamp.HashMethod
     else:
         method = jobstamp.MTimeMethod
 
-    result = jobstamp.run(_run_cmd,
-                          cmd,
-                          jobstamps_dependencies=namespace.dependencies,
-                          jobstamps_output_files=namespace.output_files,
-                          jobstamps_cache_output_directory=stamp_directory,
-                          jobstamps_method=method)
+    command = _Command(cmd,
+                       cwd_sensitive=namespace.cwd_sensitive,
+                       env=namespace.env,
+                       stdin=(getattr(sys.stdin, "buffer", sys.stdin)
+                              if namespace.stdin else None))
+    kwargs = {
+        "jobstamps_dependencies": _canonical_paths(namespace.dependencies),
+        "jobstamps_output_files": _canonical_paths(namespace.output_files),
+        "jobstamps_cache_output_directory": stamp_directory,
+        "jobstamps_method": method,
+        "jobstamps_deduplicate": namespace.deduplicate,
+        "jobstamps_index": namespace.index,
+        "jobstamps_ledger": namespace.ledger
+    }
+    try:
+        # Only the stamp for this command is needed, so the rest of the
+        # snapshot is not loaded.
+        if namespace.prefetch:
+            prefetch.load_snapshot(namespace.prefetch,
+                                   stamp_directory or
+                                   jobstamp.default_cache_directory(),
+                                   names=[jobstamp.job_key(_run_cmd,
+                                                           command,
+                                                           **kwargs)])
+
+        result = jobstamp.run(_run_cmd, command, **kwargs)
+    finally:
+        if command.stdin is not None:
+            command.stdin.close()
 
     sys.stdout.write(result["stdout"].decode())
     sys.stderr.write(result["stderr"].decode())
@@ -0,0 +1,183 @@
+# /jobstamps/layout.py
+#
+# Layout of the stamp files within a cache directory.
+#
+# By default, every stamp and its sidecar files are stored directly in
+# the cache directory. Very large caches can instead use a sharded layout,
+# where each file is stored in two levels of subdirectories named after
+# the first four hex digits of its name. The layout is recorded in a
+# marker file in the cache directory, which is written by migrate.
+#
+# See /LICENCE.md for Copyright information
+"""Layout of the stamp files within a cache directory."""
+
+import json
+
+import os
+
+import threading
+
+from jobstamps import fileutil
+
+FLAT = "flat"
+SHARDED = "sharded"
+
+MARKER = ".jobstamps-layout"
+
+# Files stored beside a stamp, named by appending these suffixes.
+SIDECAR_SUFFIXES = (".dep.sha1", ".deps", ".cost", ".hits")
+
+_VERSION = 1
+_LAYOUTS = dict()
+_LAYOUTS_LOCK = threading.Lock()
+
+
+def _read_layout(directory):
+    """Return layout recorded in the marker file in directory."""
+    try:
+        with open(os.path.join(directory, MARKER), "rb") as marker:
+            contents = json.loads(marker.read().decode("utf-8"))
+    except (IOError, OSError):
+        return FLAT
+
+    if contents.get("version", 0) > _VERSION:
+        raise RuntimeError("""{} uses a stamp layout from a newer version """
+                           """of jobstamps.""".format(directory))
+
+    return contents.get("layout", FLAT)
+
+
+def layout_for(directory):
+    """Return layout of directory.
+
+    The marker file is only read the first time a directory is used,
+    so layout changes made by other processes are not seen until restart.
+    Lookups fall back to the flat layout, so stamps written by such
+    processes are still found.
+    """
+    with _LAYOUTS_LOCK:
+        if directory not in _LAYOUTS:
+            _LAYOUTS[directory] = _read_layout(directory)
+
+        return _LAYOUTS[directory]
+
+
+def forget_layout(directory):
+    """Read the layout of directory again the next time it is used."""
+    with _LAYOUTS_LOCK:
+        _LAYOUTS.pop(directory, None)
+
+
+def path_in_layout(directory, name, layout):
+    """Return path for the file called name in directory with layout."""
+    if layout == SHARDED:
+        return os.path.join(directory, name[:2], name[2:4], name)
+
+    return os.path.join(directory, name)
+
+
+def stamp_path(directory, name):
+    """Return path at which the file called name is stored in directory."""
+    return path_in_layout(directory, name, layout_for(directory))
+
+
+def directory_of(stamp):
+    """Return the cache directory holding the file at path stamp."""
+    root, name = os.path.split(stamp)
+    parent, second = os.path.split(root)
+    directory, first = os.path.split(parent)
+    if ((first, second) == (name[:2], name[2:4]) and
+            layout_for(directory) == SHARDED):
+        return directory
+
+    return root
+
+
+def find_stamp(directory, name):
+    """Return path to the stamp called name in directory.
+
+    If directory is sharded and the stamp is not in its shard, but is
+    stored in the flat layout, for instance because directory is being
+    migrated, then the flat path is returned. Otherwise, the path at which
+    the stamp should be stored is returned.
+    """
+    layout = layout_for(directory)
+    path = path_in_layout(directory, name, layout)
+    if layout == FLAT or os.path.exists(path):
+        return path
+
+    flat_path = path_in_layout(directory, name, FLAT)
+    if os.path.exists(flat_path):
+        return flat_path
+
+    return path
+
+
+def walk(directory):
+    """Return list of (root, file names) for directories within directory.
+
+    Hidden subdirectories, which hold data other than stamps, are not
+    included. Each directory is listed before its subdirectories.
+    """
+    walked = list()
+    for root, subdirectories, files in os.walk(directory):
+        subdirectories[:] = [d for d in subdirectories if
+                             not d.startswith(".")]
+        walked.append((root, files))
+
+    return walked
+
+
+def _move_without_replacing(source, destination):
+    """Move source to destination, unless destination already exists.
+
+    If destination exists, it was written after migration began and
+    is newer, so source is removed instead.
+    """
+    if os.path.exists(destination):
+        os.remove(source)
+        return
+
+    fileutil.safe_mkdir(os.path.dirname(destination))
+    os.rename(source, destination)
+
+
+def migrate(directory, layout=SHARDED):
+    """Convert the stamps in directory to layout, in place.
+
+    The marker is written first, so that new stamps are written in the
+    new layout while existing ones are moved. Lookups fall back to the
+    flat layout in the meantime. Return the number of files moved.
+    """
+    fileutil.safe_mkdir(directory)
+    fileutil.write_atomically(os.path.join(directory, MARKER),
+                              json.dumps({
+                                  "version": _VERSION,
+                                  "layout": layout
+                              }).encode("utf-8"))
+
+    with _LAYOUTS_LOCK:
+        _LAYOUTS[directory] = layout
+
+    moved = 0
+    for root, files in reversed(walk(directory)):
+        for name in files:
+            # Markers and temporary files are skipped.
+            if name.startswith("."):
+                continue
+
+            source = os.path.join(root, name)
+            destination = path_in_layout(directory, name, layout)
+            if source != destination:
+                _move_without_replacing(source, destination)
+                moved += 1
+
+        # Shards emptied by the migration are removed, unless another
+        # process has since written a stamp into them.
+        if root != directory and not os.listdir(root):
+            try:
+                os.rmdir(root)
+            except OSError:
+                continue
+
+    return moved
@@ -0,0 +1,214 @@
+# /jobstamps/ledger.py
+#
+# Record of what each stamped job cost to run and how often it was reused.
+#
+# Jobs are only recorded if they are run with jobstamps_ledger set. Each
+# time such a job is run, a small JSON file is written beside its stamp,
+# recording the job's name and arguments, how long it took and the size
+# of its stamp. Neither file requires the stamp itself to be unpickled in
+# order to be read.
+#
+# Runs and hits are counted in memory, so that reusing a stamp does not
+# write anything straight away. The counts are appended to another file
+# beside each stamp as a single record when the ledger is flushed, which
+# happens when jobstamp.flush() is called, at exit, or once counts are
+# pending for too many stamps. Counts which have not yet been flushed are
+# lost if the process is killed.
+#
+# See /LICENCE.md for Copyright information
+"""Record of what each stamped job cost to run and how often it was reused."""
+
+import atexit
+
+import json
+
+import os
+
+import struct
+
+import threading
+
+import time
+
+from collections import namedtuple
+
+from jobstamps import fileutil
+from jobstamps import layout
+
+COST_SUFFIX = ".cost"
+HITS_SUFFIX = ".hits"
+
+# Each flush appends the number of runs and hits since the last flush and
+# the time of the last of those hits, or zero if there were none.
+_COUNTS_RECORD = struct.Struct(">IId")
+
+# Counts are flushed once they are pending for this many stamps.
+_PENDING_LIMIT = 1024
+
+_PENDING = dict()
+_PENDING_LOCK = threading.Lock()
+
+# Arguments are only recorded to help identify a job in reports, so
+# very long representations are truncated.
+_ARGUMENTS_LENGTH = 200
+
+Entry = namedtuple("Entry",
+                   "stamp job arguments duration size runs hits last_hit")
+
+
+def _read_cost(stamp):
+    """Return dict stored in the cost file for stamp, or None."""
+    try:
+        with open(stamp + COST_SUFFIX, "rb") as cost_file:
+            return json.loads(cost_file.read().decode("utf-8"))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def describe_arguments(args):
+    """Return representation of args suitable for recording."""
+    arguments = repr(args)
+    if len(arguments) > _ARGUMENTS_LENGTH:
+        return arguments[:_ARGUMENTS_LENGTH - 3] + "..."
+
+    return arguments
+
+
+def _count(stamp, runs, hits):
+    """Add runs and hits to the counts pending for stamp."""
+    with _PENDING_LOCK:
+        counts = _PENDING.setdefault(stamp, [0, 0, 0.0])
+        counts[0] += runs
+        counts[1] += hits
+        if hits:
+            counts[2] = time.time()
+
+        full = len(_PENDING) >= _PENDING_LIMIT
+
+    if full:
+        flush()
+
+
+def record_run(stamp, job, arguments, duration):
+    """Record that job with arguments took duration seconds to run.
+
+    stamp must already have been written.
+    """
+    fileutil.write_atomically(stamp + COST_SUFFIX,
+                              json.dumps({
+                                  "job": job,
+                                  "arguments": arguments,
+                                  "duration": duration,
+                                  "size": os.stat(stamp).st_size,
+                                  "written": time.time()
+                              }).encode("utf-8"))
+    _count(stamp, 1, 0)
+
+
+def record_hit(stamp):
+    """Record that stamp was reused."""
+    _count(stamp, 0, 1)
+
+
+def _append_counts(stamp, runs, hits, last_hit):
+    """Append counts for stamp to its counts file, ignoring failures.
+
+    Failures are ignored, since a stamp may be reused from a directory
+    which cannot be written to.
+    """
+    try:
+        descriptor = os.open(stamp + HITS_SUFFIX,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                             0o666)
+    except OSError:
+        return
+
+    try:
+        os.write(descriptor, _COUNTS_RECORD.pack(runs, hits, last_hit))
+    except OSError:
+        return
+    finally:
+        os.close(descriptor)
+
+
+def flush():
+    """Append the counts pending for each stamp to its counts file."""
+    with _PENDING_LOCK:
+        pending = dict(_PENDING)
+        _PENDING.clear()
+
+    for stamp, counts in pending.items():
+        _append_counts(stamp, *counts)
+
+
+atexit.register(flush)
+
+
+def _read_counts(stamp):
+    """Return (runs, hits, time of last hit or None) for stamp.
+
+    Counts pending in this process are included.
+    """
+    records = list()
+    try:
+        with open(stamp + HITS_SUFFIX, "rb") as counts_file:
+            contents = counts_file.read()
+    except (IOError, OSError):
+        contents = b""
+
+    for offset in range(0,
+                        len(contents) - _COUNTS_RECORD.size + 1,
+                        _COUNTS_RECORD.size):
+        records.append(_COUNTS_RECORD.unpack_from(contents, offset))
+
+    with _PENDING_LOCK:
+        if stamp in _PENDING:
+            records.append(tuple(_PENDING[stamp]))
+
+    last_hit = max([r[2] for r in records if r[1]] or [None])
+    return (sum(r[0] for r in records),
+            sum(r[1] for r in records),
+            last_hit)
+
+
+def entry(stamp):
+    """Return Entry recorded for stamp, or None if it has no record."""
+    cost = _read_cost(stamp)
+    if cost is None:
+        return None
+
+    runs, hits, last_hit = _read_counts(stamp)
+    return Entry(stamp,
+                 cost.get("job"),
+                 cost.get("arguments"),
+                 cost.get("duration", 0.0),
+                 cost.get("size", 0),
+                 runs,
+                 hits,
+                 last_hit)
+
+
+def entries(directory):
+    """Return list of Entry for each recorded stamp in directory."""
+    recorded = list()
+    for root, files in layout.walk(directory):
+        for name in files:
+            if name.endswith(COST_SUFFIX) and not name.startswith("."):
+                recorded_entry = entry(os.path.join(root,
+                                                    name[:-len(COST_SUFFIX)]))
+                if recorded_entry is not None:
+                    recorded.append(recorded_entry)
+
+    return recorded
+
+
+def time_saved(recorded_entry):
+    """Return seconds saved by reusing the stamp for recorded_entry."""
+    return recorded_entry.hits * recorded_entry.duration
+
+
+def hit_rate(recorded_entries):
+    """Return proportion of lookups of recorded_entries which were hits."""
+    hits = sum(e.hits for e in recorded_entries)
+    lookups = hits + sum(e.runs for e in recorded_entries)
+    return float(hits) / lookups if lookups else 0.0
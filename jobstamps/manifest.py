@@ -0,0 +1,170 @@
+# /jobstamps/manifest.py
+#
+# Storage for the dependency hashes recorded by HashMethod.
+#
+# Manifests are written in a compact binary format, which can be memory
+# mapped and searched without parsing the whole file. Manifests written
+# by older versions of jobstamps as JSON objects are still readable.
+#
+# The binary format is laid out as follows, with all integers stored
+# as little-endian unsigned 32 bit values:
+#
+#     magic (8 bytes) | count
+#     count * (path offset | path length), sorted by path
+#     count * raw digest (20 bytes each)
+#     utf-8 encoded paths
+#
+# See /LICENCE.md for Copyright information
+"""Storage for the dependency hashes recorded by HashMethod."""
+
+import binascii
+
+import json
+
+import mmap
+
+import struct
+
+from jobstamps import fileutil
+
+_MAGIC = b"JSTMPMF1"
+_HEADER = struct.Struct("<8sI")
+_INDEX_ENTRY = struct.Struct("<II")
+DIGEST_SIZE = 20
+
+
+class EmptyManifest(object):
+    """A manifest with no recorded hashes."""
+
+    def get(self, path):  # suppress(no-self-use)
+        """Return None, since no path has a recorded hash."""
+        del path
+
+    def close(self):  # suppress(no-self-use)
+        """Perform nothing."""
+        pass
+
+
+class JSONManifest(object):
+    """A manifest stored as a JSON object of paths to hex digests."""
+
+    def __init__(self, contents):
+        """Parse contents as JSON."""
+        super(JSONManifest, self).__init__()
+        self._hashes = json.loads(contents.decode("utf-8"))
+
+    def get(self, path):
+        """Return raw digest for path, or None if it was not recorded."""
+        hexdigest = self._hashes.get(path)
+        if not hexdigest:
+            return None
+
+        return binascii.unhexlify(hexdigest)
+
+    def close(self):  # suppress(no-self-use)
+        """Perform nothing."""
+        pass
+
+
+class BinaryManifest(object):
+    """A manifest in the compact binary format.
+
+    The manifest is usually memory mapped, but may be any buffer.
+    """
+
+    def __init__(self, mapping):
+        """Store the mapping and read the header."""
+        super(BinaryManifest, self).__init__()
+        self._mapping = mapping
+        self._count = _HEADER.unpack_from(mapping, 0)[1]
+        self._index_offset = _HEADER.size
+        self._digests_offset = (self._index_offset +
+                                self._count * _INDEX_ENTRY.size)
+
+    def _path_at(self, index):
+        """Return encoded path at index."""
+        offset, length = _INDEX_ENTRY.unpack_from(self._mapping,
+                                                  self._index_offset +
+                                                  index * _INDEX_ENTRY.size)
+        return self._mapping[offset:offset + length]
+
+    def get(self, path):
+        """Return raw digest for path, or None if it was not recorded.
+
+        Paths are stored in sorted order, so this is a binary search
+        which only touches the pages of the mapping that it needs.
+        """
+        encoded = path.encode("utf-8")
+        low = 0
+        high = self._count
+
+        while low < high:
+            middle = (low + high) // 2
+            candidate = self._path_at(middle)
+            if candidate < encoded:
+                low = middle + 1
+            elif candidate > encoded:
+                high = middle
+            else:
+                start = self._digests_offset + middle * DIGEST_SIZE
+                return self._mapping[start:start + DIGEST_SIZE]
+
+        return None
+
+    def close(self):
+        """Unmap the manifest, if it is mapped."""
+        if isinstance(self._mapping, mmap.mmap):
+            self._mapping.close()
+
+
+def load(path):
+    """Return a manifest object for the manifest stored at path."""
+    try:
+        manifest_file = open(path, "rb")
+    except (IOError, OSError):
+        return EmptyManifest()
+
+    with manifest_file:
+        magic = manifest_file.read(len(_MAGIC))
+        if not magic:
+            return EmptyManifest()
+
+        if magic != _MAGIC:
+            manifest_file.seek(0)
+            return JSONManifest(manifest_file.read())
+
+        mapping = mmap.mmap(manifest_file.fileno(),
+                            0,
+                            access=mmap.ACCESS_READ)
+        return BinaryManifest(mapping)
+
+
+def from_bytes(contents):
+    """Return a manifest object for a manifest already read into memory."""
+    if not contents:
+        return EmptyManifest()
+
+    if not contents.startswith(_MAGIC):
+        return JSONManifest(contents)
+
+    return BinaryManifest(contents)
+
+
+def write(path, digests):
+    """Write a dict of paths to raw digests to path in binary format."""
+    entries = sorted((p.encode("utf-8"), d) for p, d in digests.items())
+    paths_offset = (_HEADER.size +
+                    len(entries) * (_INDEX_ENTRY.size + DIGEST_SIZE))
+
+    chunks = [_HEADER.pack(_MAGIC, len(entries))]
+    offset = paths_offset
+    for encoded, _ in entries:
+        chunks.append(_INDEX_ENTRY.pack(offset, len(encoded)))
+        offset += len(encoded)
+
+    chunks.extend(d for _, d in entries)
+    chunks.extend(e for e, _ in entries)
+
+    # The new manifest is moved into place, so that readers which have the
+    # old manifest mapped are not affected.
+    fileutil.write_atomically(path, b"".join(chunks))
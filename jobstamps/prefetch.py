@@ -0,0 +1,272 @@
+# /jobstamps/prefetch.py
+#
+# Bulk loading of stamps into memory ahead of the checks which use them.
+#
+# A process which knows which jobs it will check can load their stamps
+# and sidecar files in a single pass over the cache directory, or from a
+# packed snapshot file written by pack, instead of opening each file
+# when its job is checked. Prefetched contents are only used while the
+# stamp on disk is unchanged since it was prefetched.
+#
+# Each stamp in a snapshot is stored as a small pickled header, giving its
+# path relative to the cache directory, its signature and the length of
+# the pickled contents which follow. The stamps are followed by a table of
+# their names and offsets, sorted by name, and a trailer giving the offset
+# of the table and the number of stamps, with integers stored as
+# big-endian unsigned 64 bit values:
+#
+#     magic (8 bytes)
+#     count * (pickled header | pickled contents)
+#     count * (name (32 bytes) | offset), sorted by name
+#     table offset | count
+#
+# Loading only some of the stamps in a snapshot binary searches the table
+# for each of them, so the headers and contents of the others are not
+# read.
+#
+# See /LICENCE.md for Copyright information
+"""Bulk loading of stamps into memory ahead of the checks which use them."""
+
+import mmap
+
+import os
+
+import pickle
+
+import struct
+
+import threading
+
+from collections import namedtuple
+
+from jobstamps import fileutil
+from jobstamps import layout
+
+_SNAPSHOT_MAGIC = b"JSTMPPK2"
+
+# Stamp names are hex digests, so each fits in a fixed size table entry.
+_NAME_SIZE = 32
+_TABLE_ENTRY = struct.Struct(">{}sQ".format(_NAME_SIZE))
+_TRAILER = struct.Struct(">QQ")
+
+_Entry = namedtuple("_Entry", "signature files")
+
+_ENTRIES = dict()
+_ENTRIES_LOCK = threading.Lock()
+
+
+def _signature(stat_result):
+    """Return a tuple which changes when the file in stat_result changes.
+
+    The inode number is not included, so that snapshots remain usable
+    for copies of a cache directory which preserve modification times.
+    """
+    return (getattr(stat_result, "st_mtime_ns", stat_result.st_mtime),
+            stat_result.st_size)
+
+
+def _is_stamp_name(name):
+    """Return True if name is the name of a stamp rather than a sidecar."""
+    return not name.startswith(".") and "." not in name
+
+
+def _stamps_in(directory, names=None):
+    """Return list of (path, stat result) for stamps in directory.
+
+    If names is passed, only stamps called one of names are returned.
+    The list is sorted by inode number, which approximates the order
+    in which the stamps are stored on disk.
+    """
+    if names is not None:
+        paths = [layout.find_stamp(directory, n) for n in names]
+    else:
+        paths = [os.path.join(root, name)
+                 for root, files in layout.walk(directory)
+                 for name in files
+                 if _is_stamp_name(name)]
+
+    stamps = list()
+    for path in paths:
+        try:
+            stamps.append((path, os.stat(path)))
+        except OSError:
+            continue
+
+    return sorted(stamps, key=lambda s: s[1].st_ino)
+
+
+def _read_stamp_files(path):
+    """Return dict of suffix to contents for stamp at path and sidecars."""
+    files = dict()
+    for suffix in ("",) + layout.SIDECAR_SUFFIXES:
+        try:
+            with open(path + suffix, "rb") as stamp_file:
+                files[suffix] = stamp_file.read()
+        except (IOError, OSError):
+            continue
+
+    return files
+
+
+def load_directory(directory, names=None):
+    """Load stamps in directory into memory, returning how many were loaded.
+
+    If names is passed, only the stamps with those names (as returned by
+    jobstamp.job_key) are loaded, otherwise every stamp is loaded.
+    """
+    loaded = dict()
+    for path, stat_result in _stamps_in(directory, names):
+        loaded[path] = _Entry(_signature(stat_result),
+                              _read_stamp_files(path))
+
+    with _ENTRIES_LOCK:
+        _ENTRIES.update(loaded)
+
+    return len(loaded)
+
+
+def pack(directory, snapshot, names=None):
+    """Write stamps in directory to the single file snapshot.
+
+    If names is passed, only the stamps with those names are written.
+    Return the number of stamps written.
+    """
+    stamps = _stamps_in(directory, names)
+    table = list()
+    fileobj, temporary = fileutil.temporary_file_beside(snapshot)
+    try:
+        with fileobj:
+            fileobj.write(_SNAPSHOT_MAGIC)
+            for path, stat_result in stamps:
+                table.append((os.path.basename(path).encode("utf-8"),
+                              fileobj.tell()))
+                files = pickle.dumps(_read_stamp_files(path), 2)
+                pickle.dump((os.path.relpath(path, directory),
+                             _signature(stat_result),
+                             len(files)),
+                            fileobj,
+                            2)
+                fileobj.write(files)
+
+            table_offset = fileobj.tell()
+            for name, offset in sorted(table):
+                fileobj.write(_TABLE_ENTRY.pack(name, offset))
+
+            fileobj.write(_TRAILER.pack(table_offset, len(table)))
+        fileutil.replace_file(temporary, snapshot)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+    return len(stamps)
+
+
+def _find_in_table(mapping, table_offset, count, name):
+    """Return offset of the stamp called name in mapping, or None.
+
+    Names are stored in sorted order, so this is a binary search which
+    only touches the pages of the table that it needs.
+    """
+    encoded = name.encode("utf-8")[:_NAME_SIZE].ljust(_NAME_SIZE, b"\0")
+    low = 0
+    high = count
+
+    while low < high:
+        middle = (low + high) // 2
+        candidate, offset = _TABLE_ENTRY.unpack_from(mapping,
+                                                     table_offset +
+                                                     middle *
+                                                     _TABLE_ENTRY.size)
+        if candidate < encoded:
+            low = middle + 1
+        elif candidate > encoded:
+            high = middle
+        else:
+            return offset
+
+    return None
+
+
+def _read_entry(fileobj, offset):
+    """Return (relative path, _Entry) for the stamp at offset in fileobj."""
+    fileobj.seek(offset)
+    relative, signature, length = pickle.load(fileobj)
+    return relative, _Entry(signature, pickle.loads(fileobj.read(length)))
+
+
+def load_snapshot(snapshot, directory, names=None):
+    """Load stamps for directory from snapshot written by pack.
+
+    If names is passed, only the stamps with those names are loaded, and
+    they are found using the table at the end of the snapshot. Return the
+    number of stamps loaded.
+    """
+    loaded = dict()
+    with open(snapshot, "rb") as fileobj:
+        if fileobj.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+            raise IOError("""{} is not a jobstamps """
+                          """snapshot.""".format(snapshot))
+
+        mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            table_offset, count = _TRAILER.unpack_from(mapping,
+                                                       len(mapping) -
+                                                       _TRAILER.size)
+            if names is None:
+                offsets = list()
+                for index in range(count):
+                    offsets.append(_TABLE_ENTRY.unpack_from(
+                        mapping,
+                        table_offset + index * _TABLE_ENTRY.size
+                    )[1])
+            else:
+                offsets = [_find_in_table(mapping, table_offset, count, n)
+                           for n in set(names)]
+        finally:
+            mapping.close()
+
+        for offset in sorted(o for o in offsets if o is not None):
+            relative, entry = _read_entry(fileobj, offset)
+            loaded[os.path.join(directory, relative)] = entry
+
+    with _ENTRIES_LOCK:
+        _ENTRIES.update(loaded)
+
+    return len(loaded)
+
+
+def clear():
+    """Discard all prefetched stamps."""
+    with _ENTRIES_LOCK:
+        _ENTRIES.clear()
+
+
+def contents(path):
+    """Return prefetched contents of stamp or sidecar at path, or None.
+
+    None is returned if path was not prefetched, or if its stamp has
+    changed on disk since it was prefetched.
+    """
+    if not _ENTRIES:
+        return None
+
+    stamp, suffix = path, ""
+    for sidecar_suffix in layout.SIDECAR_SUFFIXES:
+        if path.endswith(sidecar_suffix):
+            stamp = path[:-len(sidecar_suffix)]
+            suffix = sidecar_suffix
+            break
+
+    with _ENTRIES_LOCK:
+        entry = _ENTRIES.get(stamp)
+
+    if entry is None or suffix not in entry.files:
+        return None
+
+    try:
+        if _signature(os.stat(stamp)) != entry.signature:
+            return None
+    except OSError:
+        return None
+
+    return entry.files[suffix]
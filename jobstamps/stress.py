@@ -0,0 +1,347 @@
+# /jobstamps/stress.py
+#
+# Load testing harness for many processes sharing one stamp directory.
+#
+# Each worker process runs a random mix of operations against the same
+# stamp directory:
+#
+#  - hit: run a job from a small pool of keys shared by every worker,
+#         which is usually cached.
+#  - miss: run a job with a key unique to this operation.
+#  - touch: rewrite the dependency shared by every job, making every
+#           stamp out of date.
+#
+# Every job logs its execution along with the version of the dependency
+# it saw, so that executions of the same job with the same dependency by
+# more than one worker can be counted as duplicates. Every result carries
+# a digest of its payload, so that corrupt or partial stamp reads can be
+# detected.
+#
+# Run python -m jobstamps.stress --help for usage.
+#
+# See /LICENCE.md for Copyright information
+"""Load testing harness for many processes sharing one stamp directory."""
+
+import argparse
+
+import hashlib
+
+import json
+
+import multiprocessing
+
+import os
+
+import random
+
+import shutil
+
+import sys
+
+import tempfile
+
+import time
+
+from collections import Counter
+
+from jobstamps import jobstamp
+
+_EXECUTIONS_LOG = "executions.log"
+_DEPENDENCY = "dependency"
+
+_OPERATIONS = ("hit", "miss", "touch")
+
+
+def _stress_job(key, workspace, payload_size, job_seconds):
+    """Job run by workers, logging its execution and returning a payload."""
+    with open(os.path.join(workspace, _DEPENDENCY), "rb") as dependency:
+        version = dependency.read().decode("utf-8")
+
+    # A single small write to a file opened for appending is atomic, so
+    # lines written by concurrent workers do not interleave.
+    line = "{} {}\n".format(key, version).encode("utf-8")
+    descriptor = os.open(os.path.join(workspace, _EXECUTIONS_LOG),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o666)
+    try:
+        os.write(descriptor, line)
+    finally:
+        os.close(descriptor)
+
+    if job_seconds:
+        time.sleep(job_seconds)
+
+    payload = os.urandom(payload_size)
+    return (key, payload, hashlib.sha1(payload).hexdigest())
+
+
+def _choose_operation(rng, mix):
+    """Return an operation chosen by rng according to the weights in mix."""
+    point = rng.uniform(0, sum(mix))
+    for operation, weight in zip(_OPERATIONS, mix):
+        point -= weight
+        if point < 0:
+            return operation
+
+    return _OPERATIONS[-1]
+
+
+def _valid_result(key, result):
+    """Return True if result is a complete result for key."""
+    try:
+        result_key, payload, digest = result
+    except (TypeError, ValueError):
+        return False
+
+    return (result_key == key and
+            hashlib.sha1(payload).hexdigest() == digest)
+
+
+def _touch_dependency(workspace):
+    """Write a new version to the dependency shared by every job."""
+    path = os.path.join(workspace, _DEPENDENCY)
+    version = "{}-{}".format(os.getpid(), time.time()).encode("utf-8")
+    temporary = "{}.{}".format(path, os.getpid())
+    with open(temporary, "wb") as dependency:
+        dependency.write(version)
+
+    getattr(os, "replace", os.rename)(temporary, path)
+
+
+def _worker(config):
+    """Run config["operations"] operations, returning latencies and counts."""
+    workspace = config["workspace"]
+    rng = random.Random(config["seed"])
+    kwargs = {
+        "jobstamps_dependencies": [os.path.join(workspace, _DEPENDENCY)],
+        "jobstamps_cache_output_directory": os.path.join(workspace, "stamps"),
+        "jobstamps_method": config["method"],
+        "jobstamps_write_behind": config["write_behind"]
+    }
+
+    latencies = list()
+    counts = Counter()
+
+    for index in range(config["operations"]):
+        operation = _choose_operation(rng, config["mix"])
+        started = time.time()
+
+        if operation == "touch":
+            _touch_dependency(workspace)
+        else:
+            if operation == "hit":
+                key = "hot-{}".format(rng.randrange(config["keys"]))
+            else:
+                key = "miss-{}-{}".format(config["seed"], index)
+
+            try:
+                result = jobstamp.run(_stress_job,
+                                      key,
+                                      workspace,
+                                      config["payload_size"],
+                                      config["job_seconds"],
+                                      **kwargs)
+                if not _valid_result(key, result):
+                    counts["corrupt"] += 1
+            except Exception:  # suppress(broad-except)
+                counts["errors"] += 1
+
+        latencies.append(time.time() - started)
+        counts[operation] += 1
+
+    try:
+        jobstamp.flush()
+    except Exception:  # suppress(broad-except)
+        counts["errors"] += 1
+
+    return latencies, counts
+
+
+def _percentile(values, percent):
+    """Return value at percent of sorted values."""
+    if not values:
+        return 0.0
+
+    index = min(len(values) - 1, int(round(percent / 100.0 * len(values))))
+    return values[index]
+
+
+def _count_duplicates(workspace):
+    """Return number of job executions which repeated another's work."""
+    try:
+        with open(os.path.join(workspace, _EXECUTIONS_LOG), "rb") as log:
+            executions = log.read().decode("utf-8").splitlines()
+    except (IOError, OSError):
+        return 0
+
+    return len(executions) - len(set(executions))
+
+
+def run_stress(workers,  # suppress(too-many-arguments)
+               operations,
+               keys=8,
+               mix=(0.8, 0.15, 0.05),
+               method=jobstamp.MTimeMethod,
+               payload_size=1024,
+               job_seconds=0.0,
+               write_behind=False,
+               seed=0,
+               directory=None):
+    """Run the stress workload with workers processes and return a report.
+
+    Each worker performs operations operations, chosen among hit, miss
+    and touch according to the weights in mix. The report is a dict of
+    throughput in operations per second, latency percentiles in seconds,
+    operation counts, duplicate job executions, corrupt results and other
+    errors.
+    """
+    workspace = tempfile.mkdtemp(dir=directory, prefix="jobstamps-stress")
+    try:
+        _touch_dependency(workspace)
+        configs = [{
+            "workspace": workspace,
+            "operations": operations,
+            "keys": keys,
+            "mix": list(mix),
+            "method": method,
+            "payload_size": payload_size,
+            "job_seconds": job_seconds,
+            "write_behind": write_behind,
+            "seed": seed * 1000 + worker
+        } for worker in range(workers)]
+
+        started = time.time()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_worker, configs)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - started
+
+        latencies = sorted(latency for worker_latencies, _ in results
+                           for latency in worker_latencies)
+        counts = Counter()
+        for _, worker_counts in results:
+            counts.update(worker_counts)
+
+        return {
+            "workers": workers,
+            "operations": len(latencies),
+            "seconds": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+            "hits": counts["hit"],
+            "misses": counts["miss"],
+            "touches": counts["touch"],
+            "duplicates": _count_duplicates(workspace),
+            "corrupt": counts["corrupt"],
+            "errors": counts["errors"]
+        }
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+_REPORT_COLUMNS = ("workers", "throughput", "p50", "p95", "p99", "max",
+                   "duplicates", "corrupt", "errors")
+
+
+def _format_report(reports):
+    """Return reports formatted as a table."""
+    lines = ["  ".join("{:>10}".format(c) for c in _REPORT_COLUMNS)]
+    for report in reports:
+        cells = list()
+        for column in _REPORT_COLUMNS:
+            value = report[column]
+            if column in ("p50", "p95", "p99", "max"):
+                cells.append("{:>8.2f}ms".format(value * 1000))
+            elif column == "throughput":
+                cells.append("{:>8.1f}/s".format(value))
+            else:
+                cells.append("{:>10}".format(value))
+
+        lines.append("  ".join(cells))
+
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    """Run the stress workload for each requested number of workers."""
+    parser = argparse.ArgumentParser(description="""Stress test concurrent """
+                                                 """use of one stamp """
+                                                 """directory""")
+    parser.add_argument("--workers",
+                        type=int,
+                        nargs="+",
+                        default=[1, 2, 4, 8],
+                        help="""Numbers of worker processes to run the """
+                             """workload with, to show scaling.""")
+    parser.add_argument("--operations",
+                        type=int,
+                        default=200,
+                        help="""Operations performed by each worker.""")
+    parser.add_argument("--keys",
+                        type=int,
+                        default=8,
+                        help="""Number of keys shared by hit operations.""")
+    parser.add_argument("--mix",
+                        type=float,
+                        nargs=3,
+                        metavar=("HIT", "MISS", "TOUCH"),
+                        default=[0.8, 0.15, 0.05],
+                        help="""Relative weights of each operation.""")
+    parser.add_argument("--use-hashes",
+                        action="store_true",
+                        help="""Use HashMethod instead of MTimeMethod.""")
+    parser.add_argument("--write-behind",
+                        action="store_true",
+                        help="""Write stamps on a background thread.""")
+    parser.add_argument("--payload-size",
+                        type=int,
+                        default=1024,
+                        help="""Size in bytes of each job's result.""")
+    parser.add_argument("--job-seconds",
+                        type=float,
+                        default=0.0,
+                        help="""Time each job spends running.""")
+    parser.add_argument("--directory",
+                        metavar="DIRECTORY",
+                        help="""Directory in which to create the shared """
+                             """stamp directory, for instance on a """
+                             """network filesystem.""")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="""Seed for choosing operations.""")
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="""Print reports as JSON.""")
+    namespace = parser.parse_args(argv)
+
+    method = (jobstamp.HashMethod if namespace.use_hashes
+              else jobstamp.MTimeMethod)
+    reports = [run_stress(workers,
+                          namespace.operations,
+                          keys=namespace.keys,
+                          mix=namespace.mix,
+                          method=method,
+                          payload_size=namespace.payload_size,
+                          job_seconds=namespace.job_seconds,
+                          write_behind=namespace.write_behind,
+                          seed=namespace.seed,
+                          directory=namespace.directory)
+               for workers in namespace.workers]
+
+    if namespace.json:
+        sys.stdout.write(json.dumps(reports, indent=2) + "\n")
+    else:
+        sys.stdout.write(_format_report(reports))
+
+    return 1 if any(r["corrupt"] or r["errors"] for r in reports) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+# /jobstamps/tiers.py
+#
+# Lookup of stamps across several cache directories of differing speed.
+#
+# A TieredCache holds a list of CacheTier objects, ordered from the
+# fastest (usually a local directory) to the slowest (usually a shared
+# network directory), and optionally an in-memory cache of loaded results.
+#
+# See /LICENCE.md for Copyright information
+"""Lookup of stamps across several cache directories of differing speed."""
+
+import inspect
+
+import os
+
+import shutil
+
+import threading
+
+import time
+
+from collections import OrderedDict
+
+from jobstamps import blobs
+from jobstamps import fileutil
+from jobstamps import layout
+
+WRITE_ALL = "all"
+WRITE_FASTEST = "fastest"
+
+# Weight given to the latest lookup when updating a tier's average latency.
+_LATENCY_WEIGHT = 0.2
+
+
+class CacheTier(object):
+    """A directory in which stamps are looked up and stored.
+
+    If timeout is set and looking up a stamp in this tier takes longer
+    than timeout seconds, or fails with an error, the tier is bypassed for
+    the next bypass_for seconds.
+    """
+
+    def __init__(self, directory, timeout=None, bypass_for=60):
+        """Initialize this tier and its statistics."""
+        super(CacheTier, self).__init__()
+        self.directory = directory
+        self.timeout = timeout
+        self.bypass_for = bypass_for
+        self.latency = None
+        self.hits = 0
+        self.misses = 0
+        self._bypass_until = 0
+
+    def __repr__(self):
+        """Return representation of this tier."""
+        return "CacheTier({!r})".format(self.directory)
+
+    def bypassed(self):
+        """Return True if this tier is currently being bypassed."""
+        return time.time() < self._bypass_until
+
+    def record_lookup(self, seconds, hit):
+        """Record that a lookup took seconds, bypassing if too slow."""
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += _LATENCY_WEIGHT * (seconds - self.latency)
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        if self.timeout is not None and seconds > self.timeout:
+            self.bypass()
+
+    def bypass(self):
+        """Bypass this tier for the next bypass_for seconds."""
+        self._bypass_until = time.time() + self.bypass_for
+
+
+def _copy_stamp(stamp, directory, sidecar_suffixes):
+    """Copy stamp and its sidecar files into directory.
+
+    Modification times are preserved, so that dependencies are compared
+    against the time at which the stamp was originally written. The stamp
+    is copied last, so that a reader never sees it without its sidecars,
+    and after any blob it names.
+    """
+    name = os.path.basename(stamp)
+    blobs.copy_referenced(stamp, directory)
+    for suffix in tuple(sidecar_suffixes) + ("",):
+        source = stamp + suffix
+        if not os.path.exists(source):
+            continue
+
+        destination = layout.stamp_path(directory, name + suffix)
+        fileutil.safe_mkdir(os.path.dirname(destination))
+        fileobj, temporary = fileutil.temporary_file_beside(destination)
+        fileobj.close()
+        try:
+            shutil.copy2(source, temporary)
+            fileutil.replace_file(temporary, destination)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+
+class TieredCache(object):
+    """Stamps looked up in each of tiers in turn, promoting any hit.
+
+    A hit in a slower tier is copied into each faster tier. When a job is
+    re-run, its stamp is written to the fastest available tier and then,
+    if write_policy is WRITE_ALL, copied to every other available tier.
+    Tiers being bypassed are skipped, unless every tier is bypassed.
+
+    If memory_entries is set, up to that many loaded results are also kept
+    in memory and returned for stamps which have not changed since they
+    were loaded. Those results are shared between callers, so they should
+    not be modified.
+    """
+
+    def __init__(self, tiers, write_policy=WRITE_ALL, memory_entries=0):
+        """Initialize tiers, which may be CacheTier objects or directories."""
+        super(TieredCache, self).__init__()
+        if not tiers:
+            raise ValueError("""At least one tier must be specified.""")
+
+        if write_policy not in (WRITE_ALL, WRITE_FASTEST):
+            raise ValueError("""Unknown write policy """
+                             """{}""".format(write_policy))
+
+        self.tiers = [t if isinstance(t, CacheTier) else CacheTier(t)
+                      for t in tiers]
+        self.write_policy = write_policy
+        self._memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._memory_lock = threading.Lock()
+
+    def __repr__(self):
+        """Return representation of this cache."""
+        return "TieredCache({!r})".format(self.tiers)
+
+    def available_tiers(self):
+        """Return tiers not being bypassed, or all tiers if none are."""
+        return [t for t in self.tiers if not t.bypassed()] or self.tiers
+
+    def _tier_for_stamp(self, stamp):
+        """Return tier which stamp was stored in."""
+        return [t for t in self.tiers
+                if stamp.startswith(os.path.join(t.directory, ""))][0]
+
+    def locate(self, make_detail, check, sidecar_suffixes):
+        """Return (trigger, detail) for first tier with an up to date stamp.
+
+        make_detail is called with a tier's directory and returns the
+        detail for the stamp in that tier. check is called with that detail
+        and returns the file which is out of date, or None. If no tier is up
+        to date, the first trigger and the detail for the fastest available
+        tier are returned.
+        """
+        tiers = self.available_tiers()
+        first = None
+
+        for index, tier in enumerate(tiers):
+            detail = make_detail(tier.directory)
+            started = time.time()
+            try:
+                trigger = check(detail)
+            except (IOError, OSError):
+                if index == 0:
+                    raise
+
+                tier.bypass()
+                continue
+
+            tier.record_lookup(time.time() - started, trigger is None)
+
+            if trigger is None:
+                for faster in tiers[:index]:
+                    try:
+                        _copy_stamp(detail.stamp,
+                                    faster.directory,
+                                    sidecar_suffixes)
+                    except (IOError, OSError):
+                        faster.bypass()
+
+                return None, detail
+
+            if first is None:
+                first = (trigger, detail)
+
+        return first
+
+    def replicate(self, stamp, sidecar_suffixes):
+        """Copy stamp to other available tiers, according to write_policy."""
+        if self.write_policy != WRITE_ALL:
+            return
+
+        source = self._tier_for_stamp(stamp)
+        for tier in self.available_tiers():
+            if tier is source:
+                continue
+
+            try:
+                _copy_stamp(stamp, tier.directory, sidecar_suffixes)
+            except (IOError, OSError):
+                tier.bypass()
+
+    def load(self, stamp, loader):
+        """Return result in stamp, loading it with loader if not in memory."""
+        if not self._memory_entries:
+            return loader(stamp)
+
+        stat_result = os.stat(stamp)
+        key = (stamp,
+               getattr(stat_result, "st_mtime_ns", stat_result.st_mtime),
+               stat_result.st_size,
+               stat_result.st_ino)
+
+        with self._memory_lock:
+            if key in self._memory:
+                self._memory[key] = self._memory.pop(key)
+                return self._memory[key]
+
+        result = loader(stamp)
+
+        # Generators can only be consumed once, so they are not kept.
+        if inspect.isgenerator(result):
+            return result
+
+        with self._memory_lock:
+            self._memory[key] = result
+            while len(self._memory) > self._memory_entries:
+                self._memory.popitem(last=False)
+
+        return result
@@ -32,6 +32,7 @@ setup(name="jobstamps",
                         "shutilwhich",
                         "setuptools"],
       extras_require={
+          "numpy": ["numpy"],
           "upload": ["setuptools-markdown"]
       },
       entry_points={
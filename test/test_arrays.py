@@ -0,0 +1,132 @@
+# /test/test_arrays.py
+#
+# Unit tests for storing NumPy arrays in stamps.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for storing NumPy arrays in stamps."""
+
+import os
+
+from test import testutil
+
+from jobstamps import jobstamp
+from jobstamps import prefetch
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def _array(*shape):
+    """Return array of shape large enough to be mapped."""
+    count = 1
+    for dimension in shape:
+        count *= dimension
+
+    return numpy.arange(count, dtype="float64").reshape(shape)
+
+
+class TestArrays(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for arrays module."""
+
+    def setUp(self):  # suppress(N802)
+        """Skip if NumPy is unavailable and clear JOBSTAMPS_DISABLED."""
+        super(TestArrays, self).setUp()
+        if numpy is None:
+            self.skipTest("""NumPy is not available.""")
+
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+        self._cache = os.path.join(os.getcwd(), "cache")
+
+    def _run_twice(self, value):
+        """Stamp value and return it as loaded from the stamp."""
+        def job(_):
+            """Return value."""
+            return value
+
+        kwargs = {"jobstamps_cache_output_directory": self._cache}
+        jobstamp.run(job, 1, **kwargs)
+        return jobstamp.run(job, 1, **kwargs)
+
+    def test_large_array_mapped(self):
+        """Large array is returned as a read-only memory map of the stamp."""
+        result = self._run_twice(_array(100, 100))
+        self.assertEqual((numpy.memmap, False, False),
+                         (type(result),
+                          result.flags.owndata,
+                          result.flags.writeable))
+
+    def test_mapped_array_equal_to_stored(self):
+        """Mapped array has the same contents as the stored array."""
+        array = _array(100, 100)
+        self.assertTrue(numpy.array_equal(array, self._run_twice(array)))
+
+    def test_fortran_ordered_array_preserved(self):
+        """Fortran ordered arrays are mapped with the same order."""
+        array = numpy.asfortranarray(_array(100, 100))
+        result = self._run_twice(array)
+        self.assertEqual((numpy.memmap, True, True),
+                         (type(result),
+                          numpy.array_equal(array, result),
+                          result.flags.f_contiguous))
+
+    def test_non_contiguous_array_stored(self):
+        """Views which are not contiguous are stored by value."""
+        array = _array(200, 100)[::2, ::2]
+        self.assertTrue(numpy.array_equal(array, self._run_twice(array)))
+
+    def test_nested_arrays_mapped(self):
+        """Arrays nested in dicts and tuples are mapped."""
+        result = self._run_twice({"a": (_array(100, 100), _array(50, 300))})
+        self.assertEqual([(numpy.memmap, False), (numpy.memmap, False)],
+                         [(type(a), a.flags.writeable) for a in result["a"]])
+
+    def test_memory_map_mapped_when_stamped(self):
+        """Memory maps are stored such that they can be mapped again."""
+        array = _array(100, 100)
+        array.tofile("array")
+        memory_map = numpy.memmap("array",
+                                  dtype=array.dtype,
+                                  mode="r",
+                                  shape=array.shape)
+        result = self._run_twice(memory_map)
+        self.assertEqual((numpy.memmap, False, True),
+                         (type(result),
+                          result.flags.writeable,
+                          numpy.array_equal(array, result)))
+
+    def test_write_behind_array_unaffected_by_later_changes(self):
+        """Changes to a mapped array after it is returned are not stored."""
+        array = _array(100, 100)
+
+        def job(_):
+            """Return array."""
+            return array
+
+        kwargs = {"jobstamps_cache_output_directory": self._cache}
+        jobstamp.run(job, 1, jobstamps_write_behind=True, **kwargs)[0, 0] = -1
+        jobstamp.flush()
+        self.assertEqual(0, jobstamp.run(job, 1, **kwargs)[0, 0])
+
+    def test_small_array_pickled(self):
+        """Small arrays are pickled with the rest of the result."""
+        self.assertTrue(self._run_twice(_array(10)).flags.writeable)
+
+    def test_object_array_pickled(self):
+        """Arrays of objects are pickled with the rest of the result."""
+        array = numpy.array([str(i) for i in range(10000)], dtype=object)
+        self.assertTrue(self._run_twice(array).flags.writeable)
+
+    def test_prefetched_array_returned_as_view(self):
+        """Prefetched arrays are read-only views of the prefetched stamp."""
+        array = _array(100, 100)
+        self._run_twice(array)
+        self.addCleanup(prefetch.clear)
+        prefetch.load_directory(self._cache)
+
+        result = self._run_twice(array)
+        self.assertEqual((False, True),
+                         (result.flags.writeable,
+                          numpy.array_equal(array, result)))
@@ -0,0 +1,155 @@
+# /test/test_blobs.py
+#
+# Unit tests for deduplicated storage of results.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for deduplicated storage of results."""
+
+import os
+
+from test import testutil
+
+from jobstamps import blobs
+from jobstamps import jobstamp
+from jobstamps import layout
+from jobstamps import tiers
+
+from mock import Mock
+
+
+def _blobs_in(directory):
+    """Return list of blobs stored in directory."""
+    return [name
+            for _, _, files in os.walk(os.path.join(directory,
+                                                    blobs.DIRECTORY))
+            for name in files
+            if not name.startswith(".")]
+
+
+def _age_blobs(directory):
+    """Make every blob in directory appear to have been written long ago."""
+    for root, _, files in os.walk(os.path.join(directory, blobs.DIRECTORY)):
+        for name in files:
+            os.utime(os.path.join(root, name), (0, 0))
+
+
+class TestBlobs(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for blobs module."""
+
+    def setUp(self):  # suppress(N802)
+        """Clear results in memory and JOBSTAMPS_DISABLED before each test."""
+        super(TestBlobs, self).setUp()
+        self.addCleanup(blobs.clear)
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+        self._cache = os.path.join(os.getcwd(), "cache")
+
+    def _run(self, job, value, directory=None):
+        """Run job with value, deduplicating its result."""
+        return jobstamp.run(job,
+                            value,
+                            jobstamps_cache_output_directory=(directory or
+                                                              self._cache),
+                            jobstamps_deduplicate=True)
+
+    def _stamp(self, job, value):
+        """Return path to stamp for job with value."""
+        return layout.find_stamp(self._cache,
+                                 jobstamp.job_key(
+                                     job,
+                                     value,
+                                     jobstamps_cache_output_directory=(
+                                         self._cache
+                                     )
+                                 ))
+
+    def test_identical_results_stored_once(self):
+        """Identical results of different jobs are stored once."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 2)
+        self.assertEqual(1, len(_blobs_in(self._cache)))
+
+    def test_different_results_stored_separately(self):
+        """Different results are stored in different blobs."""
+        self._run(Mock(__name__="job", return_value="a"), 1)
+        self._run(Mock(__name__="job", return_value="b"), 2)
+        self.assertEqual(2, len(_blobs_in(self._cache)))
+
+    def test_deduplicated_result_reused(self):
+        """Deduplicated result is loaded without re-running job."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self.assertEqual(("result", 1), (self._run(job, 1), job.call_count))
+
+    def test_job_rerun_if_blob_removed(self):
+        """Job is re-run if the blob its stamp names has been removed."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        blobs_directory = os.path.join(self._cache, blobs.DIRECTORY)
+        for root, _, files in os.walk(blobs_directory):
+            for name in files:
+                os.remove(os.path.join(root, name))
+
+        blobs.clear()
+        self.assertEqual(("result", 2), (self._run(job, 1), job.call_count))
+
+    def test_collect_removes_unreferenced_blobs(self):
+        """Blobs not named by any stamp are removed by collect."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        _age_blobs(self._cache)
+        os.remove(self._stamp(job, 1))
+        self.assertEqual((1, []),
+                         (blobs.collect(self._cache)[0],
+                          _blobs_in(self._cache)))
+
+    def test_collect_keeps_referenced_blobs(self):
+        """Blobs named by a stamp are kept by collect."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 2)
+        _age_blobs(self._cache)
+        os.remove(self._stamp(job, 1))
+        blobs.collect(self._cache)
+        self.assertEqual(1, len(_blobs_in(self._cache)))
+
+    def test_collect_keeps_recent_blobs(self):
+        """Recently written blobs are kept by collect."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        os.remove(self._stamp(job, 1))
+        blobs.collect(self._cache)
+        self.assertEqual(1, len(_blobs_in(self._cache)))
+
+    def test_reused_blob_kept(self):
+        """Blobs stored again by another job are marked as recently used."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        _age_blobs(self._cache)
+        self._run(job, 2)
+        os.remove(self._stamp(job, 1))
+        os.remove(self._stamp(job, 2))
+        self.assertEqual((0, 0), blobs.collect(self._cache, grace=60))
+
+    def test_blob_found_after_migration(self):
+        """Blobs are found from stamps moved into shards."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        layout.migrate(self._cache)
+        blobs.clear()
+        self.assertEqual(("result", 1), (self._run(job, 1), job.call_count))
+
+    def test_blob_copied_between_tiers(self):
+        """Blobs are copied along with stamps promoted between tiers."""
+        job = Mock(__name__="job", return_value="result")
+        jobstamp.run(job,
+                     1,
+                     jobstamps_cache_tiers=tiers.TieredCache(["shared"]),
+                     jobstamps_deduplicate=True)
+        jobstamp.run(job,
+                     1,
+                     jobstamps_cache_tiers=tiers.TieredCache(["local",
+                                                              "shared"]),
+                     jobstamps_deduplicate=True)
+        self.assertEqual(_blobs_in("shared"), _blobs_in("local"))
@@ -0,0 +1,137 @@
+# /test/test_index.py
+#
+# Unit tests for the reverse dependency index.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for the reverse dependency index."""
+
+import os
+
+import time
+
+from test import testutil
+
+from jobstamps import index
+from jobstamps import jobstamp
+from jobstamps import layout
+
+from mock import Mock
+
+
+class TestIndex(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for index module."""
+
+    def setUp(self):  # suppress(N802)
+        """Create dependencies and clear JOBSTAMPS_DISABLED."""
+        super(TestIndex, self).setUp()
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+        self._cache = os.path.join(os.getcwd(), "cache")
+        for name in ("a", "b", "c"):
+            with open(name, "w"):
+                pass
+
+    def _run(self, job, value, dependencies):
+        """Run job with value and dependencies, returning its key."""
+        kwargs = {
+            "jobstamps_dependencies": dependencies,
+            "jobstamps_cache_output_directory": self._cache,
+            "jobstamps_index": True
+        }
+        jobstamp.run(job, value, **kwargs)
+        return jobstamp.job_key(job, value, **kwargs)
+
+    def test_affected_finds_dependent_stamps(self):
+        """Stamps depending on a changed file are found."""
+        job = Mock(__name__="job", return_value=None)
+        first = self._run(job, 1, ["a", "b"])
+        second = self._run(job, 2, ["b"])
+        self._run(job, 3, ["c"])
+
+        self.assertEqual(sorted([first, second]),
+                         index.affected(self._cache, ["b"]))
+
+    def test_affected_accepts_absolute_paths(self):
+        """Changed files may be given as absolute paths."""
+        job = Mock(__name__="job", return_value=None)
+        key = self._run(job, 1, ["a"])
+        self.assertEqual([key],
+                         index.affected(self._cache, [os.path.abspath("a")]))
+
+    def test_affected_ignores_missing_stamps(self):
+        """Stamps which no longer exist are not returned."""
+        job = Mock(__name__="job", return_value=None)
+        key = self._run(job, 1, ["a"])
+        os.remove(os.path.join(self._cache, key))
+        self.assertEqual([], index.affected(self._cache, ["a"]))
+
+    def test_rewritten_stamp_listed_once(self):
+        """Stamps written more than once are only returned once."""
+        job = Mock(__name__="job", return_value=None)
+        self._run(job, 1, ["a"])
+        os.utime("a", (time.time() + 10, time.time() + 10))
+        key = self._run(job, 1, ["a"])
+        self.assertEqual((2, [key]),
+                         (job.call_count, index.affected(self._cache, ["a"])))
+
+    def test_rewritten_stamp_recorded_once(self):
+        """Index files hold one line for a stamp written more than once."""
+        job = Mock(__name__="job", return_value=None)
+        self._run(job, 1, ["a"])
+        os.utime("a", (time.time() + 10, time.time() + 10))
+        self._run(job, 1, ["a"])
+        index_files = [os.path.join(root, name)
+                       for root, _, files in os.walk(os.path.join(
+                           self._cache,
+                           index.DIRECTORY
+                       ))
+                       for name in files]
+        with open(index_files[0]) as index_file:
+            self.assertEqual((1, 1), (len(index_files),
+                                      len(index_file.readlines())))
+
+    def test_index_files_created_with_same_mode_as_other_files(self):
+        """Index files get the mode open() gives new files."""
+        if os.name == "nt":
+            self.skipTest("""File modes are not meaningful on Windows.""")
+
+        job = Mock(__name__="job", return_value=None)
+        self._run(job, 1, ["a"])
+        index_files = [os.path.join(root, name)
+                       for root, _, files in os.walk(os.path.join(
+                           self._cache,
+                           index.DIRECTORY
+                       ))
+                       for name in files]
+        self.assertEqual(os.stat("a").st_mode,
+                         os.stat(index_files[0]).st_mode)
+
+    def test_stamps_not_indexed_by_default(self):
+        """Stamps are only indexed when jobstamps_index is set."""
+        job = Mock(__name__="job", return_value=None)
+        jobstamp.run(job,
+                     1,
+                     jobstamps_dependencies=["a"],
+                     jobstamps_cache_output_directory=self._cache)
+        self.assertEqual((False, []),
+                         (os.path.exists(os.path.join(self._cache,
+                                                      index.DIRECTORY)),
+                          index.affected(self._cache, ["a"])))
+
+    def test_invalidate_reruns_affected_jobs(self):
+        """Jobs depending on changed files are re-run after invalidation."""
+        job = Mock(__name__="job", return_value=None)
+        self._run(job, 1, ["a"])
+        self._run(job, 2, ["b"])
+        index.invalidate(self._cache, ["a"])
+
+        self._run(job, 1, ["a"])
+        self._run(job, 2, ["b"])
+        self.assertEqual(3, job.call_count)
+
+    def test_affected_in_sharded_directory(self):
+        """Stamps are found after migrating to a sharded layout."""
+        job = Mock(__name__="job", return_value=None)
+        key = self._run(job, 1, ["a"])
+        layout.migrate(self._cache)
+        self.assertEqual([key], index.affected(self._cache, ["a"]))
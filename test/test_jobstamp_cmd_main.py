@@ -5,6 +5,8 @@
 # See /LICENCE.md for Copyright information
 """Acceptance tests for the jobstamp command."""
 
+import io
+
 import os
 
 import shutil
@@ -16,6 +18,10 @@ from test import testutil
 from iocapture import capture
 
 from jobstamps import jobstamp_cmd_main
+from jobstamps import ledger
+from jobstamps import prefetch
+
+from mock import patch
 
 from nose_parameterized import param, parameterized
 
@@ -171,3 +177,295 @@ class TestJobstampMain(testutil.InTemporaryDirectoryTestBase):
         with capture() as captured:
             run_executable(*flags)
             self.assertEqual(captured.stderr.replace("\r\n", "\n"), "stderr\n")
+
+    def test_migrate_command_shards_stamps(self):
+        """Move stamps into shards with migrate command."""
+        with open(self._executable_file, "w") as executable_file:
+            executable_file.write(_PYTHON_SHEBANG)
+
+        with capture():
+            run_executable()
+            jobstamp_cmd_main.main(["jobstamp", "migrate", os.getcwd()])
+
+        stamps = [n for n in os.listdir(os.getcwd())
+                  if len(n) == 32 and "." not in n]
+        self.assertEqual(list(), stamps)
+
+    def test_writes_stdout_from_prefetched_snapshot(self):
+        """Write cached stdout after prefetching packed snapshot."""
+        with open(self._executable_file, "w") as executable_file:
+            executable_file.write(_PYTHON_SHEBANG +
+                                  "import sys\n"
+                                  "sys.stdout.write(\"stdout\\n\")\n")
+
+        with capture():
+            run_executable()
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "pack",
+                                    os.getcwd(),
+                                    "snapshot"])
+
+        self.addCleanup(prefetch.clear)
+
+        stamps = [os.path.join(os.getcwd(), n)
+                  for n in os.listdir(os.getcwd())
+                  if len(n) == 32 and "." not in n]
+
+        with capture() as captured:
+            run_executable("--prefetch", "snapshot")
+            self.assertEqual(("stdout\n", True),
+                             (captured.stdout.replace("\r\n", "\n"),
+                              prefetch.contents(stamps[0]) is not None))
+
+    def test_report_command_counts_hits(self):
+        """Report time saved by reusing stamps with report command."""
+        with open(self._executable_file, "w") as executable_file:
+            executable_file.write(_PYTHON_SHEBANG)
+
+        with capture():
+            run_executable("--ledger")
+            run_executable("--ledger")
+
+        with capture() as captured:
+            jobstamp_cmd_main.main(["jobstamp", "report", os.getcwd()])
+            self.assertIn("Stamps: 1  Runs: 1  Hits: 1  Hit rate: 50.0%",
+                          captured.stdout)
+
+    def _write_counting_executable(self):
+        """Make executable record each time it is run in the runs file."""
+        with open(self._executable_file, "w") as executable_file:
+            executable_file.write(_PYTHON_SHEBANG +
+                                  "with open({!r}, \"a\") as runs:\n"
+                                  "    runs.write(\"run\\n\")\n"
+                                  "".format(os.path.join(os.getcwd(),
+                                                         "runs")))
+
+        return os.path.join(os.getcwd(), "runs")
+
+    def _run_counting(self, runs, args, cmd_args):  # suppress(no-self-use)
+        """Run executable with args and cmd_args, returning times run."""
+        with capture():
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "--stamp-directory",
+                                    os.path.dirname(runs)] +
+                                   args +
+                                   ["--", "executable"] +
+                                   cmd_args)
+
+        with open(runs) as runs_file:
+            return len(runs_file.readlines())
+
+    def test_relative_and_absolute_paths_share_stamp(self):
+        """Reuse result when path argument is given relatively instead."""
+        runs = self._write_counting_executable()
+        with open("input", "w"):
+            pass
+
+        self._run_counting(runs, [], [os.path.abspath("input")])
+        self.assertEqual(1, self._run_counting(runs, [], ["./input"]))
+
+    def test_path_option_values_made_canonical(self):
+        """Reuse result when --option=path value is given relatively."""
+        runs = self._write_counting_executable()
+        with open("input", "w"):
+            pass
+
+        self._run_counting(runs, [], ["--in={}".format(os.path.abspath(
+            "input"
+        ))])
+        self.assertEqual(1, self._run_counting(runs, [], ["--in=./input"]))
+
+    def test_working_directory_ignored_by_default(self):
+        """Reuse result when run from another working directory."""
+        runs = self._write_counting_executable()
+        self._run_counting(runs, [], ["arg"])
+        os.mkdir("subdirectory")
+        os.chdir("subdirectory")
+        self.assertEqual(1, self._run_counting(runs, [], ["arg"]))
+
+    def test_cwd_sensitive_command_rerun_in_other_directory(self):
+        """Re-run cwd sensitive command from another working directory."""
+        runs = self._write_counting_executable()
+        self._run_counting(runs, ["--cwd-sensitive"], ["arg"])
+        os.mkdir("subdirectory")
+        os.chdir("subdirectory")
+        self.assertEqual(2, self._run_counting(runs,
+                                               ["--cwd-sensitive"],
+                                               ["arg"]))
+
+    def test_rerun_when_listed_environment_variable_changes(self):
+        """Re-run command when variable passed with --env changes."""
+        runs = self._write_counting_executable()
+        self.addCleanup(lambda: os.environ.pop("JOBSTAMPS_TEST_VAR", None))
+        os.environ["JOBSTAMPS_TEST_VAR"] = "1"
+        self._run_counting(runs, ["--env", "JOBSTAMPS_TEST_VAR"], [])
+        os.environ["JOBSTAMPS_TEST_VAR"] = "2"
+        self.assertEqual(2, self._run_counting(runs,
+                                               ["--env", "JOBSTAMPS_TEST_VAR"],
+                                               []))
+
+    def test_listed_environment_variable_not_recorded(self):
+        """Value of variable passed with --env is not kept in the ledger."""
+        with open(self._executable_file, "w") as executable_file:
+            executable_file.write(_PYTHON_SHEBANG)
+
+        self.addCleanup(lambda: os.environ.pop("JOBSTAMPS_TEST_VAR", None))
+        os.environ["JOBSTAMPS_TEST_VAR"] = "secret"
+        with capture():
+            run_executable("--env", "JOBSTAMPS_TEST_VAR", "--ledger")
+
+        self.assertNotIn("secret",
+                         ledger.entries(os.getcwd())[0].arguments)
+
+    def test_unlisted_environment_variable_ignored(self):
+        """Reuse result when variable not passed with --env changes."""
+        runs = self._write_counting_executable()
+        self.addCleanup(lambda: os.environ.pop("JOBSTAMPS_TEST_VAR", None))
+        os.environ["JOBSTAMPS_TEST_VAR"] = "1"
+        self._run_counting(runs, [], [])
+        os.environ["JOBSTAMPS_TEST_VAR"] = "2"
+        self.assertEqual(1, self._run_counting(runs, [], []))
+
+    def test_order_of_dependencies_ignored(self):
+        """Reuse result when dependencies are listed in another order."""
+        runs = self._write_counting_executable()
+        for name in ("a", "b"):
+            with open(name, "w"):
+                pass
+
+        self._run_counting(runs, ["--dependencies", "a", "b"], [])
+        self.assertEqual(1, self._run_counting(runs,
+                                               ["--dependencies", "b", "a"],
+                                               []))
+
+    def _run_with_stdin(self, runs, contents):  # suppress(no-self-use)
+        """Run executable with contents as stdin, returning stdout."""
+        stdin = io.TextIOWrapper(io.BytesIO(contents))
+        with patch("sys.stdin", stdin), capture() as captured:
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "--stamp-directory",
+                                    os.path.dirname(runs),
+                                    "--stdin",
+                                    "--",
+                                    "executable"])
+            return captured.stdout.replace("\r\n", "\n")
+
+    def _write_counting_filter(self):
+        """Make executable echo stdin, recording each time it is run."""
+        runs = self._write_counting_executable()
+        with open(self._executable_file, "a") as executable_file:
+            executable_file.write("import sys\n"
+                                  "sys.stdout.write(sys.stdin.read())\n")
+
+        return runs
+
+    def test_stdin_passed_to_command(self):
+        """Pass stdin to command with --stdin."""
+        runs = self._write_counting_filter()
+        self.assertEqual("input\n", self._run_with_stdin(runs, b"input\n"))
+
+    def test_spooled_stdin_passed_to_command(self):
+        """Pass stdin larger than memory limit to command with --stdin."""
+        runs = self._write_counting_filter()
+        with patch.object(jobstamp_cmd_main, "_STDIN_MEMORY_LIMIT", 4):
+            self.assertEqual("input\n",
+                             self._run_with_stdin(runs, b"input\n"))
+
+    def test_same_stdin_reuses_result(self):
+        """Reuse result without running command for the same stdin."""
+        runs = self._write_counting_filter()
+        self._run_with_stdin(runs, b"input\n")
+        self.assertEqual("input\n", self._run_with_stdin(runs, b"input\n"))
+
+        with open(runs) as runs_file:
+            self.assertEqual(1, len(runs_file.readlines()))
+
+    def test_different_stdin_reruns_command(self):
+        """Re-run command when stdin differs."""
+        runs = self._write_counting_filter()
+        self._run_with_stdin(runs, b"input\n")
+        self.assertEqual("other\n", self._run_with_stdin(runs, b"other\n"))
+
+    def test_invalidate_command_reruns_dependent_command(self):
+        """Re-run command after invalidating its changed dependency."""
+        runs = self._write_counting_executable()
+        with open("input", "w"):
+            pass
+
+        self._run_counting(runs, ["--dependencies", "input", "--index"], [])
+        with capture():
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "invalidate",
+                                    os.getcwd(),
+                                    "--changed",
+                                    "input"])
+
+        self.assertEqual(2, self._run_counting(runs,
+                                               ["--dependencies",
+                                                "input",
+                                                "--index"],
+                                               []))
+
+    def test_invalidate_command_resolves_changed_links(self):
+        """Re-run command after invalidating a link to its dependency."""
+        if not hasattr(os, "symlink"):
+            self.skipTest("""Symbolic links are not available.""")
+
+        runs = self._write_counting_executable()
+        with open("input", "w"):
+            pass
+
+        os.symlink("input", "link")
+        self._run_counting(runs, ["--dependencies", "input", "--index"], [])
+        with capture():
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "invalidate",
+                                    os.getcwd(),
+                                    "--changed",
+                                    "link"])
+
+        self.assertEqual(2, self._run_counting(runs,
+                                               ["--dependencies",
+                                                "input",
+                                                "--index"],
+                                               []))
+
+    def test_invalidate_dry_run_lists_dependent_stamps(self):
+        """List stamps depending on changed file without removing them."""
+        runs = self._write_counting_executable()
+        with open("input", "w"):
+            pass
+
+        self._run_counting(runs, ["--dependencies", "input", "--index"], [])
+        with capture() as captured:
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "invalidate",
+                                    os.getcwd(),
+                                    "--changed",
+                                    "input",
+                                    "--dry-run"])
+            self.assertEqual(1, len(captured.stdout.split()))
+
+        self.assertEqual(1, self._run_counting(runs,
+                                               ["--dependencies",
+                                                "input",
+                                                "--index"],
+                                               []))
+
+    def test_collect_command_removes_unused_results(self):
+        """Remove deduplicated output no longer used with collect command."""
+        runs = self._write_counting_executable()
+        self._run_counting(runs, ["--deduplicate"], ["a"])
+        self._run_counting(runs, ["--deduplicate"], ["b"])
+        for name in os.listdir(os.getcwd()):
+            if len(name) == 32 and "." not in name:
+                os.remove(name)
+
+        with capture() as captured:
+            jobstamp_cmd_main.main(["jobstamp",
+                                    "collect",
+                                    os.getcwd(),
+                                    "--grace",
+                                    "-60"])
+            self.assertEqual("Removed 1 results, freeing",
+                             captured.stdout[:26])
@@ -5,17 +5,25 @@
 # See /LICENCE.md for Copyright information
 """Unit tests for the jobstamps module."""
 
+import glob
+
+import hashlib
+
+import json
+
 import os
 
 import shutil
 
+import sys
+
 import time
 
 from test import testutil
 
 from jobstamps import jobstamp
 
-from mock import Mock, call
+from mock import Mock, call, patch
 
 from nose_parameterized import param, parameterized
 
@@ -32,6 +40,47 @@ class MockJob(Mock):
         self.return_value = None
 
 
+class GeneratorJob(object):
+    """A job which yields the numbers up to its argument."""
+
+    __name__ = "generator_job"
+
+    def __init__(self):
+        """Initialize call count."""
+        super(GeneratorJob, self).__init__()
+        self.calls = 0
+
+    def __call__(self, count):
+        """Record call and return generator."""
+        self.calls += 1
+        return (i for i in range(count))
+
+
+def _count_characters(path):
+    """Return number of characters in path, logging the call to calls."""
+    with open("calls", "a") as calls_file:
+        calls_file.write(path + "\n")
+
+    with open(path) as input_file:
+        return len(input_file.read())
+
+
+def _read_calls():
+    """Return list of paths logged by _count_characters."""
+    with open("calls") as calls_file:
+        return calls_file.read().splitlines()
+
+
+def _define_job(body):
+    """Return function named job with body, counting calls in job.calls."""
+    namespace = {"__name__": "jobs"}
+    exec("def job(value):\n"  # suppress(exec-used)
+         "    job.calls.append(value)\n"
+         "    " + body + "\n", namespace)
+    namespace["job"].calls = []
+    return namespace["job"]
+
+
 def _update_method_doc(func, num, params):
     """Format docstring for tests with different update methods."""
     del num
@@ -44,10 +93,44 @@ def _update_method_doc(func, num, params):
     raise RuntimeError("""Unknown method {}""".format(params[0][0]))
 
 
+def _options_doc(func, num, params):
+    """Format docstring for tests with extra jobstamps options."""
+    del num
+
+    options = ", ".join("{}={}".format(k, v)
+                        for k, v in sorted(params[0][0].items()))
+    return func.__doc__[:-1] + """ with {}""".format(options)
+
+
+def _calls_doc(func, num, params):
+    """Format docstring for tests comparing two calls."""
+    del num
+
+    def _format(args, kwargs):
+        """Format args and kwargs as a call."""
+        formatted = [repr(a) for a in args] + [
+            "{}={!r}".format(k, v) for k, v in sorted(kwargs.items())
+        ]
+        return "job({})".format(", ".join(formatted))
+
+    return func.__doc__[:-1] + """ for {} and {}""".format(
+        _format(*params[0][0:2]),
+        _format(*params[0][2:4])
+    )
+
+
+def _processes_doc(func, num, params):
+    """Format docstring for tests with different numbers of processes."""
+    del num
+
+    return func.__doc__[:-1] + """ with {} processes""".format(params[0][0])
+
+
 class TestJobstamps(testutil.InTemporaryDirectoryTestBase):
     """TestCase for jobstamps module."""
 
     _METHODS = (param(jobstamp.MTimeMethod), param(jobstamp.HashMethod))
+    _PROCESSES = (param(1), param(2))
 
     def setUp(self):  # suppress(invalid-name)
         """Clear the JOBSTAMPS_ALWAYS_USE_HASHES variable before each test."""
@@ -79,6 +162,22 @@ class TestJobstamps(testutil.InTemporaryDirectoryTestBase):
         jobstamp.run(job, 1, jobstamps_cache_output_directory=cache_directory)
         self.assertThat(cache_directory, DirExists())
 
+    def test_stampfile_created_with_same_mode_as_other_files(self):
+        """Stamp file gets the mode open() gives new files."""
+        if os.name == "nt":
+            self.skipTest("""File modes are not meaningful on Windows.""")
+
+        cwd = os.getcwd()
+        kwargs = {"jobstamps_cache_output_directory": cwd}
+        jobstamp.run(MockJob(), 1, **kwargs)
+
+        with open(os.path.join(cwd, "other"), "w"):
+            pass
+
+        stamp = os.path.join(cwd, jobstamp.job_key(MockJob(), 1, **kwargs))
+        self.assertEqual(os.stat(os.path.join(cwd, "other")).st_mode,
+                         os.stat(stamp).st_mode)
+
     def test_can_create_cache_directory_in_nested_directories(self):
         """Running job creates stamp file directory, even if nested."""
         os.chdir("..")
@@ -442,3 +541,484 @@ class TestJobstamps(testutil.InTemporaryDirectoryTestBase):
                      jobstamps_cache_output_directory=os.getcwd())
 
         job.assert_called_once_with(1)
+
+    @parameterized.expand([
+        param({"jobstamps_stat_workers": 1}),
+        param({"jobstamps_stat_workers": 8}),
+        param({"jobstamps_group_by_directory": True}),
+        param({"jobstamps_stat_workers": 8,
+               "jobstamps_group_by_directory": True})
+    ], testcase_func_doc=_options_doc)
+    def test_first_deleted_dependency_is_out_of_date(self, options):
+        """First deleted dependency in list is reported as out of date."""
+        job = MockJob()
+        cwd = os.getcwd()
+        dependencies = [os.path.join(cwd, "dependency{}".format(i))
+                        for i in range(100)]
+        for dependency in dependencies:
+            with open(dependency, "w") as dependency_file:
+                dependency_file.write("Contents")
+
+        jobstamp.run(job,
+                     1,
+                     jobstamps_dependencies=dependencies,
+                     jobstamps_cache_output_directory=cwd)
+
+        os.remove(dependencies[70])
+        os.remove(dependencies[50])
+
+        ret = jobstamp.out_of_date(job,
+                                   1,
+                                   jobstamps_dependencies=dependencies,
+                                   jobstamps_cache_output_directory=cwd,
+                                   **options)
+        self.assertEqual(dependencies[50], ret)
+
+    def test_dependencies_missed_by_directory_scan_found(self):
+        """Dependencies not listed by a directory scan are looked up."""
+        job = MockJob()
+        cwd = os.getcwd()
+        dependencies = [os.path.join(cwd, "dependency{}".format(i))
+                        for i in range(2)]
+        for dependency in dependencies:
+            with open(dependency, "w") as dependency_file:
+                dependency_file.write("Contents")
+
+        kwargs = {
+            "jobstamps_dependencies": dependencies,
+            "jobstamps_cache_output_directory": cwd,
+            "jobstamps_group_by_directory": True
+        }
+        jobstamp.run(job, 1, **kwargs)
+
+        # As on case-insensitive filesystems, where a dependency may be
+        # spelled differently from the name of its directory entry.
+        with patch("os.scandir", return_value=iter([]), create=True):
+            with patch("jobstamps.jobstamp._SCAN_DIRECTORIES", True):
+                self.assertEqual(None, jobstamp.out_of_date(job, 1, **kwargs))
+
+    def test_directory_not_scanned_outside_windows(self):
+        """Dependencies are looked up separately outside of Windows."""
+        if os.name == "nt":
+            self.skipTest("""Directories are scanned on Windows.""")
+
+        job = MockJob()
+        cwd = os.getcwd()
+        dependencies = [os.path.join(cwd, "dependency{}".format(i))
+                        for i in range(2)]
+        for dependency in dependencies:
+            with open(dependency, "w") as dependency_file:
+                dependency_file.write("Contents")
+
+        kwargs = {
+            "jobstamps_dependencies": dependencies,
+            "jobstamps_cache_output_directory": cwd,
+            "jobstamps_group_by_directory": True
+        }
+        jobstamp.run(job, 1, **kwargs)
+
+        with patch("os.scandir", create=True) as scandir:
+            jobstamp.out_of_date(job, 1, **kwargs)
+
+        scandir.assert_not_called()
+
+    def test_stat_options_do_not_change_stamp(self):
+        """Dependency checking options do not affect the stamp file used."""
+        job = MockJob()
+        cwd = os.getcwd()
+        jobstamp.run(job,
+                     1,
+                     jobstamps_cache_output_directory=cwd,
+                     jobstamps_stat_workers=4,
+                     jobstamps_group_by_directory=True)
+        ret = jobstamp.out_of_date(job,
+                                   1,
+                                   jobstamps_cache_output_directory=cwd)
+        self.assertEqual(None, ret)
+
+    def test_hash_method_reads_json_manifest(self):
+        """HashMethod reads dependency hashes stored as JSON."""
+        job = MockJob()
+        cwd = os.getcwd()
+        dependency = os.path.join(cwd, "dependency")
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Contents")
+
+        jobstamp.run(job,
+                     1,
+                     jobstamps_dependencies=[dependency],
+                     jobstamps_cache_output_directory=cwd,
+                     jobstamps_method=jobstamp.HashMethod)
+
+        hashes_path = glob.glob(os.path.join(cwd, "*.dep.sha1"))[0]
+        with open(hashes_path, "w") as hashes_file:
+            hashes_file.write(json.dumps({
+                dependency: hashlib.sha1(b"Contents").hexdigest()
+            }))
+
+        ret = jobstamp.out_of_date(job,
+                                   1,
+                                   jobstamps_dependencies=[dependency],
+                                   jobstamps_cache_output_directory=cwd,
+                                   jobstamps_method=jobstamp.HashMethod)
+        self.assertEqual(None, ret)
+
+    @parameterized.expand(_METHODS, testcase_func_doc=_update_method_doc)
+    def test_generator_job_yields_items(self, method):
+        """Generator job yields its items when first run."""
+        job = GeneratorJob()
+        result = jobstamp.run(job,
+                              3,
+                              jobstamps_cache_output_directory=os.getcwd(),
+                              jobstamps_method=method)
+        self.assertEqual([0, 1, 2], list(result))
+
+    @parameterized.expand(_METHODS, testcase_func_doc=_update_method_doc)
+    def test_generator_job_items_replayed_from_cache(self, method):
+        """Generator job items are replayed from cache on next run."""
+        job = GeneratorJob()
+        cwd = os.getcwd()
+        list(jobstamp.run(job,
+                          3,
+                          jobstamps_cache_output_directory=cwd,
+                          jobstamps_method=method))
+        result = jobstamp.run(job,
+                              3,
+                              jobstamps_cache_output_directory=cwd,
+                              jobstamps_method=method)
+        self.assertEqual(([0, 1, 2], 1), (list(result), job.calls))
+
+    def test_generator_job_not_stamped_until_exhausted(self):
+        """Generator job is still out of date if not fully consumed."""
+        job = GeneratorJob()
+        cwd = os.getcwd()
+        result = jobstamp.run(job, 3, jobstamps_cache_output_directory=cwd)
+        next(result)
+        result.close()
+
+        ret = jobstamp.out_of_date(job,
+                                   3,
+                                   jobstamps_cache_output_directory=cwd)
+        self.assertNotEqual(None, ret)
+
+    @parameterized.expand(_METHODS, testcase_func_doc=_update_method_doc)
+    def test_memoized_job_runs_once(self, method):
+        """Memoized job runs only once for the same arguments."""
+        job = _define_job("return value")
+        cwd = os.getcwd()
+        memoized = jobstamp.memoize(job,
+                                    jobstamps_cache_output_directory=cwd,
+                                    jobstamps_method=method)
+        self.assertEqual((1, 1, [1]), (memoized(1), memoized(1), job.calls))
+
+    def test_memoized_job_runs_again_with_different_args(self):
+        """Memoized job runs again when called with different arguments."""
+        job = _define_job("return value")
+        cwd = os.getcwd()
+        decorator = jobstamp.memoize(jobstamps_cache_output_directory=cwd)
+        memoized = decorator(job)
+        memoized(1)
+        memoized(2)
+        self.assertEqual([1, 2], job.calls)
+
+    def test_memoized_job_runs_again_when_code_changes(self):
+        """Memoized job runs again when its code changes."""
+        cwd = os.getcwd()
+        memoized = jobstamp.memoize(_define_job("return value"),
+                                    jobstamps_cache_output_directory=cwd)
+        changed = jobstamp.memoize(_define_job("return value + 1"),
+                                   jobstamps_cache_output_directory=cwd)
+        self.assertEqual((1, 2), (memoized(1), changed(1)))
+
+    def test_memoized_job_runs_again_when_defaults_change(self):
+        """Memoized job runs again when its default arguments change."""
+        cwd = os.getcwd()
+        job = _define_job("return value")
+        job.__defaults__ = (1,)
+        memoized = jobstamp.memoize(job, jobstamps_cache_output_directory=cwd)
+        changed = _define_job("return value")
+        changed.__defaults__ = (2,)
+        changed = jobstamp.memoize(changed,
+                                   jobstamps_cache_output_directory=cwd)
+        self.assertEqual((1, 2), (memoized(), changed()))
+
+    @parameterized.expand([
+        param((12, 3), dict(), (1, 23), dict()),
+        param((1,), {"b": 5}, (1,), {"c": 5})
+    ], testcase_func_doc=_calls_doc)
+    def test_memoized_calls_do_not_share_stamps(self,
+                                                first_args,
+                                                first_kwargs,
+                                                second_args,
+                                                second_kwargs):
+        """Memoized calls with different arguments use different stamps."""
+        def job(a, b=0, c=0):
+            """Return arguments."""
+            return (a, b, c)
+
+        memoized = jobstamp.memoize(job,
+                                    jobstamps_cache_output_directory=(
+                                        os.getcwd()
+                                    ))
+        memoized(*first_args, **first_kwargs)
+        self.assertEqual(job(*second_args, **second_kwargs),
+                         memoized(*second_args, **second_kwargs))
+
+    def test_memoized_job_runs_again_when_dependency_updated(self):
+        """Memoized job runs again when a fixed dependency is updated."""
+        job = _define_job("return value")
+        cwd = os.getcwd()
+        dependency = os.path.join(cwd, "dependency")
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Contents")
+
+        memoized = jobstamp.memoize(job,
+                                    jobstamps_dependencies=[dependency],
+                                    jobstamps_cache_output_directory=cwd)
+        memoized(1)
+
+        time.sleep(1)
+
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Updated")
+
+        memoized(1)
+        self.assertEqual([1, 1], job.calls)
+
+    def test_memoize_raises_on_unknown_option(self):
+        """Raise TypeError if an unknown option is passed to memoize."""
+        with ExpectedException(TypeError):
+            jobstamp.memoize(_define_job("return value"),
+                             jobstamps_unknown=True)
+
+    def _write_map_inputs(self):  # suppress(no-self-use)
+        """Write input files for run_map tests and return their paths."""
+        inputs = ["a", "bb", "ccc"]
+        for name in inputs:
+            with open(name, "w") as input_file:
+                input_file.write(name)
+
+        return inputs
+
+    @parameterized.expand(_PROCESSES, testcase_func_doc=_processes_doc)
+    def test_run_map_returns_results_in_order(self, processes):
+        """run_map returns results for each item in order."""
+        inputs = self._write_map_inputs()
+        results = jobstamp.run_map(_count_characters,
+                                   inputs,
+                                   dependencies_for=lambda item: [item],
+                                   processes=processes,
+                                   jobstamps_cache_output_directory="cache",
+                                   jobstamps_method=jobstamp.HashMethod)
+        self.assertEqual([1, 2, 3], results)
+
+    @parameterized.expand(_PROCESSES, testcase_func_doc=_processes_doc)
+    def test_run_map_reruns_only_changed_items(self, processes):
+        """run_map only re-runs items whose dependencies changed."""
+        inputs = self._write_map_inputs()
+        kwargs = {
+            "dependencies_for": lambda item: [item],
+            "processes": processes,
+            "jobstamps_cache_output_directory": "cache",
+            "jobstamps_method": jobstamp.HashMethod
+        }
+        jobstamp.run_map(_count_characters, inputs, **kwargs)
+
+        with open("bb", "w") as input_file:
+            input_file.write("changed")
+
+        results = jobstamp.run_map(_count_characters, inputs, **kwargs)
+        self.assertEqual(([1, 7, 3], ["a", "bb", "bb", "ccc"]),
+                         (results, sorted(_read_calls())))
+
+    def test_run_map_reruns_all_items_on_shared_dependency_change(self):
+        """run_map re-runs every item when a shared dependency changes."""
+        inputs = self._write_map_inputs()
+        with open("shared", "w") as shared_file:
+            shared_file.write("Contents")
+
+        kwargs = {
+            "dependencies_for": lambda item: [item],
+            "processes": 1,
+            "jobstamps_dependencies": ["shared"],
+            "jobstamps_cache_output_directory": "cache",
+            "jobstamps_method": jobstamp.HashMethod
+        }
+        jobstamp.run_map(_count_characters, inputs, **kwargs)
+
+        with open("shared", "w") as shared_file:
+            shared_file.write("Updated")
+
+        jobstamp.run_map(_count_characters, inputs, **kwargs)
+        self.assertEqual(sorted(inputs * 2), sorted(_read_calls()))
+
+    @parameterized.expand(_METHODS, testcase_func_doc=_update_method_doc)
+    def test_write_behind_stamp_used_after_flush(self, method):
+        """Stamp written behind is used after flushing."""
+        job = MockJob()
+        job.return_value = "expected"
+        cwd = os.getcwd()
+        dependency = os.path.join(cwd, "dependency")
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Contents")
+
+        kwargs = {
+            "jobstamps_dependencies": [dependency],
+            "jobstamps_cache_output_directory": cwd,
+            "jobstamps_method": method,
+            "jobstamps_write_behind": True
+        }
+        jobstamp.run(job, 1, **kwargs)
+        jobstamp.flush()
+
+        self.assertEqual(("expected", 1),
+                         (jobstamp.run(job, 1, **kwargs), job.call_count))
+
+    def test_write_behind_stamp_unaffected_by_later_changes(self):
+        """Changes to result after it is returned are not written behind."""
+        job = MockJob()
+        job.return_value = [1]
+        cwd = os.getcwd()
+        kwargs = {
+            "jobstamps_cache_output_directory": cwd,
+            "jobstamps_write_behind": True
+        }
+        jobstamp.run(job, 1, **kwargs).append("x")
+        jobstamp.flush()
+
+        self.assertEqual([1], jobstamp.run(job, 1, **kwargs))
+
+    @parameterized.expand(_METHODS, testcase_func_doc=_update_method_doc)
+    def test_write_behind_detects_dependency_changed_during_job(self, method):
+        """Dependency modified during job is out of date with write-behind."""
+        cwd = os.getcwd()
+        dependency = os.path.join(cwd, "dependency")
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Contents")
+
+        def _modify_dependency(value):
+            """Modify dependency while running."""
+            with open(dependency, "w") as dependency_file:
+                dependency_file.write("Modified during job")
+
+            return value
+
+        kwargs = {
+            "jobstamps_dependencies": [dependency],
+            "jobstamps_cache_output_directory": cwd,
+            "jobstamps_method": method
+        }
+        jobstamp.run(_modify_dependency,
+                     1,
+                     jobstamps_write_behind=True,
+                     **kwargs)
+        jobstamp.flush()
+
+        self.assertEqual(dependency,
+                         jobstamp.out_of_date(_modify_dependency, 1, **kwargs))
+
+    @parameterized.expand(_METHODS, testcase_func_doc=_update_method_doc)
+    def test_discovered_dependency_out_of_date_when_updated(self, method):
+        """Dependency read by job is out of date when it is updated."""
+        if not hasattr(sys, "addaudithook"):
+            self.skipTest("""Audit hooks are not available.""")
+
+        cwd = os.getcwd()
+        dependency = os.path.join(cwd, "dependency")
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Contents")
+
+        kwargs = {
+            "jobstamps_cache_output_directory": os.path.join(cwd, "cache"),
+            "jobstamps_method": method,
+            "jobstamps_discover_dependencies": True
+        }
+        jobstamp.run(_count_characters, dependency, **kwargs)
+        self.assertEqual(None,
+                         jobstamp.out_of_date(_count_characters,
+                                              dependency,
+                                              **kwargs))
+
+        time.sleep(1)
+
+        with open(dependency, "w") as dependency_file:
+            dependency_file.write("Updated")
+
+        self.assertEqual(dependency,
+                         jobstamp.out_of_date(_count_characters,
+                                              dependency,
+                                              **kwargs))
+
+    def test_discovered_missing_file_out_of_date_when_created(self):
+        """File job failed to read is out of date once it is created."""
+        if not hasattr(sys, "addaudithook"):
+            self.skipTest("""Audit hooks are not available.""")
+
+        cwd = os.getcwd()
+        with open("default.cfg", "w") as default_file:
+            default_file.write("default")
+
+        def _read_configuration(_):
+            """Read override.cfg if it exists, otherwise default.cfg."""
+            try:
+                with open("override.cfg") as override_file:
+                    return override_file.read()
+            except IOError:
+                with open("default.cfg") as default_file:
+                    return default_file.read()
+
+        kwargs = {
+            "jobstamps_cache_output_directory": os.path.join(cwd, "cache"),
+            "jobstamps_discover_dependencies": True
+        }
+        jobstamp.run(_read_configuration, 1, **kwargs)
+        with open("override.cfg", "w") as override_file:
+            override_file.write("override")
+
+        self.assertEqual((os.path.join(cwd, "override.cfg"), "override"),
+                         (jobstamp.out_of_date(_read_configuration,
+                                               1,
+                                               **kwargs),
+                          jobstamp.run(_read_configuration, 1, **kwargs)))
+
+    def test_generator_function_rejected_before_stamping(self):
+        """Generator functions are rejected before anything is written."""
+        def generator_job(value):
+            """Yield value."""
+            yield value
+
+        cache_directory = os.path.join(os.getcwd(), "cache")
+        with ExpectedException(ValueError):
+            jobstamp.run(generator_job,
+                         1,
+                         jobstamps_cache_output_directory=cache_directory,
+                         jobstamps_discover_dependencies=True)
+
+        self.assertFalse(os.path.exists(cache_directory))
+
+    def test_discovered_dependencies_exclude_written_files(self):
+        """Files written by job are not discovered as dependencies."""
+        if not hasattr(sys, "addaudithook"):
+            self.skipTest("""Audit hooks are not available.""")
+
+        cwd = os.getcwd()
+        with open("dependency", "w") as dependency_file:
+            dependency_file.write("Contents")
+
+        kwargs = {
+            "jobstamps_cache_output_directory": os.path.join(cwd, "cache"),
+            "jobstamps_discover_dependencies": True
+        }
+        jobstamp.run(_count_characters, "dependency", **kwargs)
+
+        # The calls file is appended to by the job, so changing it
+        # does not make the job out of date.
+        time.sleep(1)
+
+        with open("calls", "w") as calls_file:
+            calls_file.write("Updated")
+
+        self.assertEqual(None,
+                         jobstamp.out_of_date(_count_characters,
+                                              "dependency",
+                                              **kwargs))
@@ -0,0 +1,97 @@
+# /test/test_layout.py
+#
+# Unit tests for the stamp directory layout module.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for the stamp directory layout module."""
+
+import os
+
+from test import testutil
+
+from jobstamps import jobstamp
+from jobstamps import layout
+
+from mock import Mock
+
+
+def _files_in(directory):
+    """Return sorted paths of files in directory, relative to it."""
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, files in os.walk(directory)
+                  for name in files
+                  if not name.startswith("."))
+
+
+class TestLayout(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for layout module."""
+
+    def setUp(self):  # suppress(N802)
+        """Clear the JOBSTAMPS_DISABLED variable before each test."""
+        super(TestLayout, self).setUp()
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+
+    def _run(self, job):  # suppress(no-self-use)
+        """Run job with hash method in cache directory."""
+        return jobstamp.run(job,
+                            1,
+                            jobstamps_cache_output_directory=os.path.join(
+                                os.getcwd(),
+                                "cache"
+                            ),
+                            jobstamps_method=jobstamp.HashMethod)
+
+    def test_migrate_moves_stamps_into_shards(self):
+        """Stamps are moved into two levels of shards by migrate."""
+        self._run(Mock(__name__="job", return_value=None))
+        layout.migrate(os.path.join(os.getcwd(), "cache"))
+
+        files = _files_in("cache")
+        self.assertEqual([os.path.join(os.path.basename(p)[:2],
+                                       os.path.basename(p)[2:4],
+                                       os.path.basename(p)) for p in files],
+                         files)
+
+    def test_stamp_used_after_migration(self):
+        """Stamp is still used after migrating to sharded layout."""
+        job = Mock(__name__="job", return_value=None)
+        self._run(job)
+        layout.migrate(os.path.join(os.getcwd(), "cache"))
+        self._run(job)
+
+        self.assertEqual(1, job.call_count)
+
+    def test_new_stamp_written_to_shard(self):
+        """New stamps are written into shards after migration."""
+        layout.migrate(os.path.join(os.getcwd(), "cache"))
+        self._run(Mock(__name__="job", return_value=None))
+
+        self.assertTrue(all(os.sep in p for p in _files_in("cache")))
+
+    def test_flat_stamp_found_in_sharded_directory(self):
+        """Stamp in flat layout is found in sharded directory."""
+        job = Mock(__name__="job", return_value=None)
+        cache = os.path.join(os.getcwd(), "cache")
+        self._run(job)
+
+        # Move only the marker into place, as though the cache directory
+        # is still being migrated.
+        layout.migrate(os.path.join(os.getcwd(), "empty"))
+        os.rename(os.path.join("empty", layout.MARKER),
+                  os.path.join(cache, layout.MARKER))
+        layout.forget_layout(cache)
+        self._run(job)
+
+        self.assertEqual((1, layout.SHARDED),
+                         (job.call_count, layout.layout_for(cache)))
+
+    def test_migrate_leaves_hidden_directories(self):
+        """Files in hidden subdirectories are not moved by migrate."""
+        hidden = os.path.join(os.getcwd(), "cache", ".hidden")
+        os.makedirs(hidden)
+        with open(os.path.join(hidden, "abcdef"), "w"):
+            pass
+
+        layout.migrate(os.path.join(os.getcwd(), "cache"))
+        self.assertEqual(["abcdef"], os.listdir(hidden))
@@ -0,0 +1,170 @@
+# /test/test_ledger.py
+#
+# Unit tests for the ledger of job costs.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for the ledger of job costs."""
+
+import os
+
+import time
+
+from test import testutil
+
+from jobstamps import jobstamp
+from jobstamps import ledger
+
+from mock import Mock
+
+
+def _sleeping_job(value):
+    """Sleep briefly and return value."""
+    time.sleep(0.05)
+    return value
+
+
+class TestLedger(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for ledger module."""
+
+    def setUp(self):  # suppress(N802)
+        """Clear the JOBSTAMPS_DISABLED variable before each test."""
+        super(TestLedger, self).setUp()
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+        self._cache = os.path.join(os.getcwd(), "cache")
+
+    def _run(self, job, value, **kwargs):
+        """Run job with value using the ledger, returning its result."""
+        return jobstamp.run(job,
+                            value,
+                            jobstamps_cache_output_directory=self._cache,
+                            jobstamps_ledger=True,
+                            **kwargs)
+
+    def _entry(self):
+        """Return the only entry in the ledger."""
+        entries = ledger.entries(self._cache)
+        self.assertEqual(1, len(entries))
+        return entries[0]
+
+    def test_run_records_job_and_arguments(self):
+        """Name and arguments of job are recorded when it is run."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        entry = self._entry()
+        self.assertEqual(("job", "(1,)", 1, 0, None),
+                         (entry.job,
+                          entry.arguments,
+                          entry.runs,
+                          entry.hits,
+                          entry.last_hit))
+
+    def test_nothing_recorded_without_ledger(self):
+        """Jobs are not recorded unless jobstamps_ledger is set."""
+        job = Mock(__name__="job", return_value="result")
+        jobstamp.run(job, 1, jobstamps_cache_output_directory=self._cache)
+        jobstamp.run(job, 1, jobstamps_cache_output_directory=self._cache)
+        jobstamp.flush()
+        self.assertEqual([],
+                         [n for n in os.listdir(self._cache)
+                          if n.endswith((ledger.COST_SUFFIX,
+                                         ledger.HITS_SUFFIX))])
+
+    def test_run_records_duration(self):
+        """Time taken by job is recorded when it is run."""
+        self._run(_sleeping_job, 1)
+        self.assertGreaterEqual(self._entry().duration, 0.05)
+
+    def test_run_records_size_of_stamp(self):
+        """Size of stamp is recorded when job is run."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        entry = self._entry()
+        self.assertEqual(os.stat(entry.stamp).st_size, entry.size)
+
+    def test_hits_recorded(self):
+        """Each reuse of a stamp is recorded along with the latest."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        before = time.time()
+        self._run(job, 1)
+        self._run(job, 1)
+        entry = self._entry()
+        self.assertEqual((2, True),
+                         (entry.hits, entry.last_hit >= before - 1))
+
+    def test_reruns_counted(self):
+        """Number of runs is carried over when job is run again."""
+        dependency = os.path.join(os.getcwd(), "dependency")
+        with open(dependency, "w"):
+            pass
+
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1, jobstamps_dependencies=[dependency])
+        os.utime(dependency, (time.time() + 10, time.time() + 10))
+        self._run(job, 1, jobstamps_dependencies=[dependency])
+        self.assertEqual(2, self._entry().runs)
+
+    def test_time_saved_by_hits(self):
+        """Time saved is the duration of the job for each hit."""
+        self._run(_sleeping_job, 1)
+        self._run(_sleeping_job, 1)
+        self._run(_sleeping_job, 1)
+        entry = self._entry()
+        self.assertEqual(entry.duration * 2, ledger.time_saved(entry))
+
+    def test_hit_rate_across_entries(self):
+        """Hit rate is proportion of lookups which were hits."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 1)
+        self._run(job, 2)
+        self.assertEqual(1.0 / 3, ledger.hit_rate(ledger.entries(self._cache)))
+
+    def test_generator_recorded_once_exhausted(self):
+        """Jobs returning generators are recorded once exhausted."""
+        def generator_job(value):
+            """Yield value twice."""
+            yield value
+            yield value
+
+        result = self._run(generator_job, 1)
+        self.assertEqual(list(), ledger.entries(self._cache))
+        list(result)
+        self.assertEqual(1, self._entry().runs)
+
+    def test_run_map_records_each_item(self):
+        """Each item run by run_map is recorded separately."""
+        job = Mock(__name__="job", return_value="result")
+        jobstamp.run_map(job,
+                         [1, 2],
+                         processes=1,
+                         jobstamps_cache_output_directory=self._cache,
+                         jobstamps_ledger=True)
+        self.assertEqual(["(1,)", "(2,)"],
+                         sorted(e.arguments
+                                for e in ledger.entries(self._cache)))
+
+    def test_long_arguments_truncated(self):
+        """Long representations of arguments are truncated."""
+        self.assertEqual(200, len(ledger.describe_arguments(("a" * 500,))))
+
+    def test_counts_written_on_flush(self):
+        """Runs and hits are only written, as one record, on flush."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 1)
+        self._run(job, 1)
+        hits = self._entry().stamp + ledger.HITS_SUFFIX
+        written_before_flush = os.path.exists(hits)
+        jobstamp.flush()
+        self.assertEqual((False, 16, 1, 2),
+                         (written_before_flush,
+                          os.stat(hits).st_size,
+                          self._entry().runs,
+                          self._entry().hits))
+
+    def test_unwritable_hits_ignored(self):
+        """Failure to record a hit is ignored."""
+        ledger.record_hit(os.path.join(os.getcwd(), "missing", "stamp"))
+        ledger.flush()
@@ -0,0 +1,61 @@
+# /test/test_manifest.py
+#
+# Unit tests for the dependency hash manifest module.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for the dependency hash manifest module."""
+
+import hashlib
+
+import json
+
+import os
+
+from test import testutil
+
+from jobstamps import manifest
+
+
+def _digest(contents):
+    """Return raw sha1 digest of contents."""
+    return hashlib.sha1(contents).digest()
+
+
+class TestManifest(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for manifest module."""
+
+    def test_missing_manifest_has_no_hashes(self):
+        """Manifest which does not exist has no recorded hashes."""
+        loaded = manifest.load(os.path.join(os.getcwd(), "missing"))
+        self.assertEqual(None, loaded.get("dependency"))
+
+    def test_lookup_written_paths(self):
+        """Each written path can be looked up in binary manifest."""
+        path = os.path.join(os.getcwd(), "manifest")
+        digests = {"dependency{}".format(i): _digest(str(i).encode("ascii"))
+                   for i in range(100)}
+        manifest.write(path, digests)
+
+        loaded = manifest.load(path)
+        self.addCleanup(loaded.close)
+        self.assertEqual(digests,
+                         {p: loaded.get(p) for p in digests.keys()})
+
+    def test_lookup_unwritten_path(self):
+        """Path which was not written has no hash in binary manifest."""
+        path = os.path.join(os.getcwd(), "manifest")
+        manifest.write(path, {"a": _digest(b"a"), "c": _digest(b"c")})
+
+        loaded = manifest.load(path)
+        self.addCleanup(loaded.close)
+        self.assertEqual(None, loaded.get("b"))
+
+    def test_lookup_in_json_manifest(self):
+        """Paths can be looked up in JSON manifest."""
+        path = os.path.join(os.getcwd(), "manifest")
+        with open(path, "w") as manifest_file:
+            manifest_file.write(json.dumps({
+                "a": hashlib.sha1(b"a").hexdigest()
+            }))
+
+        self.assertEqual(_digest(b"a"), manifest.load(path).get("a"))
@@ -0,0 +1,131 @@
+# /test/test_prefetch.py
+#
+# Unit tests for prefetching stamps into memory.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for prefetching stamps into memory."""
+
+import os
+
+import pickle
+
+from test import testutil
+
+from jobstamps import jobstamp
+from jobstamps import prefetch
+
+from mock import Mock, patch
+
+
+class TestPrefetch(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for prefetch module."""
+
+    def setUp(self):  # suppress(N802)
+        """Clear prefetched stamps and JOBSTAMPS_DISABLED before each test."""
+        super(TestPrefetch, self).setUp()
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+        self.addCleanup(prefetch.clear)
+        self._cache = os.path.join(os.getcwd(), "cache")
+
+    def _run(self, job, value):
+        """Run job with value, returning its result."""
+        return jobstamp.run(job,
+                            value,
+                            jobstamps_cache_output_directory=self._cache,
+                            jobstamps_method=jobstamp.HashMethod)
+
+    def _stamp(self, job, value):
+        """Return path to stamp for job with value."""
+        return os.path.join(self._cache,
+                            jobstamp.job_key(job,
+                                             value,
+                                             jobstamps_cache_output_directory=(
+                                                 self._cache
+                                             ),
+                                             jobstamps_method=(
+                                                 jobstamp.HashMethod
+                                             )))
+
+    def test_load_directory_loads_every_stamp(self):
+        """Every stamp in directory is loaded by default."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 2)
+        self.assertEqual(2, prefetch.load_directory(self._cache))
+
+    def test_load_directory_loads_named_stamps(self):
+        """Only stamps named by job key are loaded if names are passed."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 2)
+        name = os.path.basename(self._stamp(job, 1))
+        self.assertEqual(1, prefetch.load_directory(self._cache, [name]))
+
+    def test_prefetched_stamp_contents(self):
+        """Prefetched stamp contents are returned for unchanged stamp."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        prefetch.load_directory(self._cache)
+
+        contents = prefetch.contents(self._stamp(job, 1))
+        self.assertEqual("result", pickle.loads(contents))
+
+    def test_changed_stamp_not_prefetched(self):
+        """Prefetched stamp contents are not used once stamp changes."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        prefetch.load_directory(self._cache)
+
+        with open(self._stamp(job, 1), "wb") as stamp_file:
+            stamp_file.write(pickle.dumps("changed result"))
+
+        self.assertEqual(None, prefetch.contents(self._stamp(job, 1)))
+
+    def test_job_uses_stamp_from_snapshot(self):
+        """Job uses result from snapshot without being run again."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        prefetch.pack(self._cache, "snapshot")
+        prefetch.load_snapshot("snapshot", self._cache)
+
+        self.assertEqual(("result", 1), (self._run(job, 1), job.call_count))
+
+    def test_load_snapshot_loads_named_stamps(self):
+        """Only stamps named by job key are loaded from snapshot."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        self._run(job, 2)
+        self._run(job, 3)
+        prefetch.pack(self._cache, "snapshot")
+        name = os.path.basename(self._stamp(job, 2))
+        loaded = prefetch.load_snapshot("snapshot", self._cache, [name])
+
+        self.assertEqual((1, None, "result"),
+                         (loaded,
+                          prefetch.contents(self._stamp(job, 1)),
+                          pickle.loads(prefetch.contents(self._stamp(job,
+                                                                     2)))))
+
+    def test_load_snapshot_only_reads_named_headers(self):
+        """Headers of stamps which are not named are not unpickled."""
+        job = Mock(__name__="job", return_value="result")
+        for value in range(5):
+            self._run(job, value)
+
+        prefetch.pack(self._cache, "snapshot")
+        name = os.path.basename(self._stamp(job, 3))
+        with patch("jobstamps.prefetch.pickle.load",
+                   wraps=pickle.load) as load:
+            prefetch.load_snapshot("snapshot", self._cache, [name])
+
+        self.assertEqual(1, load.call_count)
+
+    def test_load_snapshot_ignores_missing_names(self):
+        """Names of stamps which were not packed are ignored."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, 1)
+        prefetch.pack(self._cache, "snapshot")
+        self.assertEqual(0, prefetch.load_snapshot("snapshot",
+                                                   self._cache,
+                                                   ["0" * 32]))
@@ -0,0 +1,53 @@
+# /test/test_stress.py
+#
+# Unit tests for the concurrent stress testing harness.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for the concurrent stress testing harness."""
+
+import os
+
+from test import testutil
+
+from jobstamps import stress
+
+
+class TestStress(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for stress module."""
+
+    def setUp(self):  # suppress(N802)
+        """Clear JOBSTAMPS_DISABLED before each test."""
+        super(TestStress, self).setUp()
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+
+    def test_report_counts_every_operation(self):
+        """Report counts operations performed by every worker."""
+        report = stress.run_stress(2, 20, directory=os.getcwd())
+        self.assertEqual(40, report["operations"])
+        self.assertEqual(40, (report["hits"] +
+                              report["misses"] +
+                              report["touches"]))
+
+    def test_no_corrupt_results_under_contention(self):
+        """No corrupt results or errors are seen by concurrent workers."""
+        report = stress.run_stress(4,
+                                   30,
+                                   keys=2,
+                                   mix=(0.6, 0.2, 0.2),
+                                   directory=os.getcwd())
+        self.assertEqual((0, 0), (report["corrupt"], report["errors"]))
+
+    def test_single_worker_never_duplicates_work(self):
+        """A single worker never runs a job which was already cached."""
+        report = stress.run_stress(1,
+                                   30,
+                                   keys=2,
+                                   mix=(1, 0, 0),
+                                   directory=os.getcwd())
+        self.assertEqual(0, report["duplicates"])
+
+    def test_workspace_is_removed(self):
+        """Stamp directory used by the workers is removed afterwards."""
+        stress.run_stress(1, 5, directory=os.getcwd())
+        self.assertEqual([], os.listdir(os.getcwd()))
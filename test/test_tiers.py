@@ -0,0 +1,95 @@
+# /test/test_tiers.py
+#
+# Unit tests for tiered stamp lookup.
+#
+# See /LICENCE.md for Copyright information
+"""Unit tests for tiered stamp lookup."""
+
+import os
+
+from test import testutil
+
+from jobstamps import jobstamp
+from jobstamps import tiers
+
+from mock import Mock
+
+
+def _stamps_in(directory):
+    """Return list of stamps in directory, or an empty list if missing.
+
+    Sidecar files, whose names contain a ".", are not included.
+    """
+    if not os.path.isdir(directory):
+        return list()
+
+    return [n for n in os.listdir(directory) if "." not in n]
+
+
+class TestTiers(testutil.InTemporaryDirectoryTestBase):
+    """TestCase for tiers module."""
+
+    def setUp(self):  # suppress(N802)
+        """Clear the JOBSTAMPS_DISABLED variable before each test."""
+        super(TestTiers, self).setUp()
+        testutil.temporarily_clear_variable_on_testsuite(self,
+                                                         "JOBSTAMPS_DISABLED")
+
+    def _run(self, job, cache):  # suppress(no-self-use)
+        """Run job with cache."""
+        return jobstamp.run(job, 1, jobstamps_cache_tiers=cache)
+
+    def test_stamp_written_to_all_tiers(self):
+        """Stamp is written to every tier with WRITE_ALL policy."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, tiers.TieredCache(["local", "shared"]))
+        self.assertEqual(_stamps_in("local"), _stamps_in("shared"))
+
+    def test_streamed_stamp_written_to_all_tiers(self):
+        """Stamp for a generator is written to every tier once exhausted."""
+        def _job(value):
+            """Yield value twice."""
+            yield value
+            yield value
+
+        list(self._run(_job, tiers.TieredCache(["local", "shared"])))
+        self.assertEqual(_stamps_in("local"), _stamps_in("shared"))
+
+    def test_stamp_written_to_fastest_tier(self):
+        """Stamp is only written to fastest tier with WRITE_FASTEST policy."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, tiers.TieredCache(["local", "shared"],
+                                         write_policy=tiers.WRITE_FASTEST))
+        self.assertEqual(list(), _stamps_in("shared"))
+
+    def test_hit_in_slower_tier_promoted(self):
+        """Hit in slower tier is copied to faster tier without re-running."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, tiers.TieredCache(["shared"]))
+        result = self._run(job, tiers.TieredCache(["local", "shared"]))
+
+        self.assertEqual(("result", 1, _stamps_in("shared")),
+                         (result, job.call_count, _stamps_in("local")))
+
+    def test_stamp_stored_in_memory(self):
+        """Loaded result is kept in memory when memory_entries is set."""
+        job = Mock(__name__="job", return_value=["result"])
+        cache = tiers.TieredCache(["local"], memory_entries=1)
+        self._run(job, cache)
+        self.assertIs(self._run(job, cache), self._run(job, cache))
+
+    def test_slow_tier_bypassed(self):
+        """Tier is bypassed after a lookup takes longer than its timeout."""
+        job = Mock(__name__="job", return_value="result")
+        shared = tiers.CacheTier("shared", timeout=0)
+        self._run(job, tiers.TieredCache(["local", shared]))
+        os.remove(os.path.join("local", _stamps_in("local")[0]))
+        self._run(job, tiers.TieredCache(["local", shared]))
+
+        self.assertEqual((True, 2), (shared.bypassed(), job.call_count))
+
+    def test_missing_tier_directory_created_on_write(self):
+        """Tier directories are created when a stamp is written."""
+        job = Mock(__name__="job", return_value="result")
+        self._run(job, tiers.TieredCache([os.path.join("a", "b")]))
+        self.assertEqual(1, len(_stamps_in(os.path.join("a", "b"))))